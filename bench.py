@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+
+# Benchmarks for midi.py
+
+# Usage:
+
+# python bench.py parse [dir]
+# python bench.py schedule [file.mid]
+# python bench.py samples [file.mid]
+# python bench.py sparse [step]
+# python bench.py startup [file.mid] [runs]
+# python bench.py render [dir]
+# python bench.py roll [file.mid]
+# python bench.py frames [out.json] [dir]
+# python bench.py store [dir] [notes]
+# python bench.py csv [dir] [notes]
+# python bench.py tracks [tracks] [notes per track] [workers]
+# python bench.py voices [dir] [ring ms]
+
+import sys, os, time, glob, tempfile, json, struct, tracemalloc, subprocess
+import pygame
+import numpy as np
+import midi, render
+
+def timed(f, repeat = 5):
+    "Return the best wall-clock time of several calls to f"
+    best = 1e9
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def bench_parse(song_dir = midi.SONG_DIR):
+    "Compare the bulk-buffer parser with the byte-at-a-time parser"
+    files = sorted(glob.glob(song_dir + "/*.mid"))
+    total = {True: 0, False: 0}
+    print("%-32s %10s %10s %8s" % ("file", "stream ms", "bulk ms", "speedup"))
+    for fn in files:
+        r = {}
+        for bulk in (False, True):
+            r[bulk] = timed(lambda: midi.MidiFile(fn, bulk = bulk))
+            total[bulk] += r[bulk]
+        print("%-32s %10.2f %10.2f %7.1fx" % (os.path.basename(fn),
+            1000 * r[False], 1000 * r[True], r[False] / r[True]))
+    print("%-32s %10.2f %10.2f %7.1fx" % ("total",
+        1000 * total[False], 1000 * total[True], total[False] / total[True]))
+
+def bench_schedule(fn = midi.SONG_DIR + "/bwv-988-v01.mid"):
+    "Show that the per-frame note lookup cost does not grow with song length"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init()
+    midi.ini(None, midi.RES)
+    surf = pygame.Surface(midi.RES)
+    # notes are queued but the scheduler thread is not started, so nothing sounds
+    now = 0
+    times, pitches = midi.song_notes(midi.song_array(midi.MidiFile(fn)))
+    span = times.max() + 1000
+    print("%10s %10s %14s" % ("notes", "frames", "scan ns/frame"))
+    for k in (1, 4, 16, 64):
+        # a synthetic song made of k copies of the piece back to back
+        midi.schedule(np.concatenate([times + i * span for i in range(k)]), np.tile(pitches, k))
+        midi.stats.update(frames = 0, scan_total_ns = 0)
+        while midi.play(surf, midi.RES, now, 1):
+            now += 10**9 // midi.TARGET_FPS
+        print("%10d %10d %14.0f" % (len(times) * k, midi.stats["frames"],
+            midi.stats["scan_total_ns"] / midi.stats["frames"]))
+
+def rss():
+    "Resident set size of this process in MB (Linux only)"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return float("nan")
+
+def bench_samples(fn = midi.SONG_DIR + "/bwv-988-v01.mid"):
+    "Compare start-up time and sample memory of eager and lazy sample loading"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init()
+    times, pitches = midi.song_notes(midi.song_array(midi.MidiFile(fn)))
+
+    # lazy first, so the eager bank does not inflate its RSS reading
+    m0 = rss()
+    t0 = time.perf_counter()
+    midi.ini(None, midi.RES)
+    t1 = time.perf_counter()
+    midi.audio.preload(pitches)
+    t2 = time.perf_counter()
+    lazy = midi.audio
+    print("lazy:  start-up %6.1f ms, %3u samples, %5.1f MB decoded, RSS +%5.1f MB (song preload %.1f ms)" %
+        (1000 * (t1 - t0), len(lazy.sounds), lazy.size / 2**20, rss() - m0, 1000 * (t2 - t1)))
+
+    # the loader before the sample bank: every key decoded at start-up
+    m0 = rss()
+    t0 = time.perf_counter()
+    eager = midi.SampleBank(cap = float("inf"))
+    eager.preload(range(2, 89))
+    t1 = time.perf_counter()
+    print("eager: start-up %6.1f ms, %3u samples, %5.1f MB decoded, RSS +%5.1f MB" %
+        (1000 * (t1 - t0), len(eager.sounds), eager.size / 2**20, rss() - m0))
+
+STARTUP = """
+import os, sys, time
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+import pygame, midi
+pygame.mixer.init()
+t0 = time.perf_counter()
+bank = midi.SampleBank(pack = %r)
+bank.preload(%r)
+print(time.perf_counter() - t0)
+"""
+
+def drop_caches():
+    "Empty the page cache so that the next run reads from disk; False if not allowed (needs root on Linux)"
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3")
+        return True
+    except OSError:
+        return False
+
+def bench_startup(fn = midi.SONG_DIR + "/bwv-988-v01.mid", runs = 5):
+    "Time loading samples in a fresh process from the WAV files and from the sample pack, with a cold and a warm page cache"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init()
+    times, pitches = midi.song_notes(midi.song_array(midi.MidiFile(fn)))
+    song = sorted(set(pitches.tolist()))
+    def run(pack, keys, cold):
+        if cold and not drop_caches():
+            return float("nan")
+        out = subprocess.run([sys.executable, "-c", STARTUP % (pack, keys)], capture_output = True, text = True, check = True)
+        return 1000 * float(out.stdout.split()[-1])
+    path = midi.pack_path(midi.SAMPLE_PACK)
+    if os.path.exists(path):
+        os.remove(path)
+    build = run(midi.SAMPLE_PACK, [2], False)
+    print("first launch, building %s: %.1f ms" % (path, build))
+    print("%-10s %12s %10s %10s" % ("loader", "keys", "cold ms", "warm ms"))
+    for keys, name in ((list(range(2, 89)), "all 87"), (song, "song's %u" % len(song))):
+        for label, pack in (("wav files", None), ("pack", midi.SAMPLE_PACK)):
+            cold = min(run(pack, keys, True) for i in range(int(runs)))
+            warm = min(run(pack, keys, False) for i in range(int(runs)))
+            print("%-10s %12s %10.1f %10.1f" % (label, name, cold, warm))
+
+def spectrum_db(a, n = 16384, floor = 60):
+    "Log magnitude spectrum in dB of the first n frames of a sample, clipped floor dB below its peak"
+    a = np.pad(a[:n], (0, max(0, n - len(a))))
+    db = 20 * np.log10(np.abs(np.fft.rfft(a * np.hanning(n))) + 1e-9)
+    return np.maximum(db, db.max() - floor)
+
+def spectral_difference(a, b, rate = midi.SAMPLE_RATE, top = 8000):
+    "RMS difference in dB between the spectra of two samples, below top Hz"
+    bins = int(top * 16384 / rate)
+    return float(np.sqrt(np.mean((spectrum_db(a)[:bins] - spectrum_db(b)[:bins]) ** 2)))
+
+def bench_sparse(step = 3):
+    "Compare the pitch-shifted keys of a sparse sample bank with the real samples and report memory saved"
+    step = int(step)
+    samples = midi.read_samples()
+    rows = []
+    for x in range(2, 89):
+        key = midi.sample_key(x, step)
+        if key != x:
+            shifted = spectral_difference(samples[x], midi.shift(samples[key], x - key))
+            # the kept sample played unshifted, as a yardstick for how far off a wrong note is
+            wrong = spectral_difference(samples[x], samples[key])
+            rows.append((x, key, shifted, wrong))
+    print("%5s %5s %12s %12s" % ("key", "from", "shifted dB", "unshifted dB"))
+    for x, key, shifted, wrong in sorted(rows, key = lambda r: -r[2])[:10]:
+        print("%5u %5u %12.2f %12.2f" % (x, key, shifted, wrong))
+    d = np.array([r[2:] for r in rows])
+    print("%u shifted keys: spectral difference mean %.2f dB, max %.2f dB (unshifted: mean %.2f dB)" %
+        (len(rows), d[:, 0].mean(), d[:, 0].max(), d[:, 1].mean()))
+
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init()
+    bank = midi.SampleBank(cap = float("inf"), step = step)
+    t0 = time.perf_counter()
+    bank.preload(range(2, 89))
+    dt = time.perf_counter() - t0
+    full = bank.full_size()
+    print("step %u: %u kept samples, %.1f MB instead of %.1f MB (%.0f%% saved); all 87 keys made in %.0f ms" %
+        (step, len(bank.sources), bank.source_size / 2**20, full / 2**20,
+        100 * (1 - bank.source_size / full), 1000 * dt))
+
+def bench_render(song_dir = midi.SONG_DIR):
+    "Report the realtime factor of the offline WAV renderer"
+    samples = midi.read_samples()
+    files = sorted(glob.glob(song_dir + "/*.mid"))
+    audio = wall = 0
+    print("%-32s %10s %10s %10s" % ("file", "audio s", "render ms", "realtime"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for fn in files:
+            t0 = time.perf_counter()
+            length = render.render(fn, os.path.join(tmp, "out.wav"), samples)
+            dt = time.perf_counter() - t0
+            audio += length
+            wall += dt
+            print("%-32s %10.1f %10.1f %9.0fx" % (os.path.basename(fn), length, 1000 * dt, length / dt))
+    print("%-32s %10.1f %10.1f %9.0fx" % ("total", audio, 1000 * wall, audio / wall))
+
+def bench_roll(fn = midi.SONG_DIR + "/bwv-988-v01.mid", frames = 1200):
+    "Compare per-frame piano roll render time of full-screen scroll and flip with the dirty-rectangle ring buffer"
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    times, pitches = midi.song_notes(midi.song_array(midi.MidiFile(fn)))
+    # the pixels to scroll and the notes to draw in each frame at 60 FPS
+    work, cursor, scrolled = [], 0, 0
+    for i in range(1, frames + 1):
+        t = i * 1000 / midi.TARGET_FPS
+        end = int(np.searchsorted(times, t))
+        px = int(t * midi.SCROLL) - scrolled
+        scrolled += px
+        work.append((px, pitches[cursor:end].tolist()))
+        cursor = end
+
+    def scroll_flip(screen, res):
+        w, h = res
+        for px, xs in work:
+            screen.scroll(dx = -px)
+            pygame.draw.rect(screen, midi.BACKGROUND, [w - px, 0, px, h])
+            for x in xs:
+                pygame.draw.rect(screen, (255,255,255), [w - 2, h - h * x // 88, 2, 2])
+            pygame.display.flip()
+
+    def ring_update(screen, res):
+        midi.roll_init(res)
+        for px, xs in work:
+            midi.roll_advance(res, px)
+            for x in xs:
+                midi.roll_note(res, x)
+            rects = midi.present(screen, res)
+            if rects:
+                pygame.display.update(rects)
+
+    def texture(screen, res):
+        # the song is rasterized beforehand, so frames only blit
+        for px, xs in work:
+            midi.scrolled += px
+            midi.dirty = True
+            rects = midi.present(screen, res)
+            if rects:
+                pygame.display.update(rects)
+
+    print("%-12s %16s %16s %16s %14s" % ("resolution", "scroll+flip us", "ring+rects us", "texture us", "prerender ms"))
+    for res in (midi.RES, (1920, 1080), (3840, 2160)):
+        screen = pygame.display.set_mode(res)
+        r = [1e6 * timed(lambda: f(screen, res), 3) / len(work) for f in (scroll_flip, ring_update)]
+        midi.schedule(times, pitches)
+        midi.PRERENDER = True
+        pre = timed(lambda: midi.prerender(res), 3)
+        r.append(1e6 * timed(lambda: (midi.schedule(times, pitches), texture(screen, res)), 3) / len(work))
+        midi.PRERENDER = False
+        print("%-12s %16.1f %16.1f %16.1f %14.1f" % ("%ux%u" % res, r[0], r[1], r[2], 1000 * pre))
+
+def bench_frames(out = "bench_frames.json", song_dir = midi.SONG_DIR):
+    "Run the real player loop headless and uncapped through a whole playlist and write frame statistics as JSON"
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    # each frame advances the song by one 60 FPS frame, however fast it really ran;
+    # this clock starts at 0, so the scheduler thread fires notes as soon as they are queued
+    song_ns = [0]
+    def clock():
+        song_ns[0] += 10**9 // midi.TARGET_FPS
+        return song_ns[0]
+
+    c = midi.MIDI(song_dir, fps = 0, clock = clock, loop = False)
+    c.frame_log = []
+    t0 = time.perf_counter()
+    c.run()
+    wall = time.perf_counter() - t0
+
+    log = np.array(c.frame_log) / 1e6
+    pct = lambda a: {"mean": float(a.mean()), "p50": float(np.percentile(a, 50)),
+        "p99": float(np.percentile(a, 99)), "max": float(a.max())}
+    result = {
+        "files": len(c.mlist),
+        "frames": len(log),
+        "wall_s": wall,
+        "fps": len(log) / wall,
+        "frame_ms": pct(log[:, 4]),
+        "phase_ms": {name: pct(log[:, i]) for i, name in enumerate(("events", "schedule", "draw", "flip"))},
+        "load_frames": midi.stats["load_frames"],
+    }
+    with open(out, "w") as f:
+        json.dump(result, f, indent = 1)
+    print("%u files, %u frames in %.1f s: %.0f FPS, frame p50 %.3f ms, p99 %.3f ms" % (result["files"],
+        result["frames"], wall, result["fps"], result["frame_ms"]["p50"], result["frame_ms"]["p99"]))
+    for name, p in result["phase_ms"].items():
+        print("  %-10s mean %.4f ms, p50 %.4f ms, p99 %.4f ms" % (name, p["mean"], p["p50"], p["p99"]))
+    print("written to", out)
+
+def write_synthetic(fn, notes, division = 480, tracks = 1):
+    "Write a MIDI file of the given number of eighth notes in every track"
+    with open(fn, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>ihhh', 6, 0 if tracks == 1 else 1, tracks, division))
+        for n in range(tracks):
+            track = bytearray(b'\x00\xff\x51\x03\x07\xa1\x20')      # 120 bpm
+            for i in range(notes):
+                # note on, then a note-on with velocity 0 after an eighth (running status)
+                track += bytes((0, 0x90 | n % 16, 36 + (i + n) % 48, 80, 0x81, 0x70, 36 + (i + n) % 48, 0))
+            track += b'\x00\xff\x2f\x00'
+            f.write(b'MTrk' + struct.pack('>i', len(track)) + track)
+
+class DictNote(object):
+    "A note with a __dict__, like Note before the columnar store"
+    def __init__(self, *fields):
+        self.channel, self.pitch, self.velocity, self.start, self.duration, self.time, self.length = fields
+
+def write_csv(fn, out):
+    "Write a MIDI file as midicsv would, with every other note-off as a note-on of velocity 0"
+    format, track_count, division = midi.read_header(open(fn, 'rb').read())[:3]
+    lines = ["0, 0, Header, %u, %u, %u" % (format, track_count, division)]
+    track, zero = -1, False
+    for e in midi.iter_events(fn, merged = False):
+        if e.track != track:
+            if track >= 0:
+                lines.append("%u, %u, End_track" % (track + 1, tick))
+            track = e.track
+            lines.append("%u, 0, Start_track" % (track + 1))
+        tick = e.tick
+        if e.kind == "note_on":
+            lines.append("%u, %u, Note_on_c, %u, %u, %u" % (track + 1, tick, e.channel, e.a, e.b))
+        elif e.kind == "note_off":
+            zero = not zero
+            lines.append("%u, %u, %s, %u, %u, %u" % (track + 1, tick, "Note_on_c" if zero else "Note_off_c",
+                e.channel, e.a, 0 if zero else e.b))
+        elif e.kind == "tempo":
+            lines.append("%u, %u, Tempo, %u" % (track + 1, tick, e.a))
+        elif e.kind == "program":
+            lines.append("%u, %u, Program_c, %u, %u" % (track + 1, tick, e.channel, e.a))
+        elif e.kind == "control":
+            lines.append("%u, %u, Control_c, %u, %u, %u" % (track + 1, tick, e.channel, e.a, e.b))
+        elif e.kind == "meta" and e.a == 0x03:
+            lines.append('%u, %u, Title_t, "%s"' % (track + 1, tick, bytes(e.b).decode('latin-1').replace('"', '""')))
+    if track >= 0:
+        lines.append("%u, %u, End_track" % (track + 1, tick))
+    lines.append("0, 0, End_of_file")
+    with open(out, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def bench_csv(song_dir = midi.SONG_DIR, synthetic = 10**6):
+    "Compare the midicsv importer with the binary parser on the same songs"
+    print("%-24s %9s %9s %12s %12s %8s" % ("file", "notes", "csv MB", "binary ms", "csv ms", "same"))
+    total = [0, 0., 0.]
+    def measure(name, fn, out):
+        write_csv(fn, out)
+        song = midi.song_array(midi.MidiFile(fn))
+        binary = timed(lambda: midi.song_array(midi.MidiFile(fn)), 3)
+        csv = timed(lambda: midi.read_csv(out), 3)
+        same = np.array_equal(song, midi.read_csv(out))
+        print("%-24s %9u %9.1f %12.2f %12.2f %8s" % (name, len(song), os.path.getsize(out) / 2**20,
+            1000 * binary, 1000 * csv, same))
+        return len(song), binary, csv
+    with tempfile.TemporaryDirectory() as tmp:
+        for fn in sorted(glob.glob(song_dir + "/*.mid")):
+            r = measure(os.path.basename(fn), fn, os.path.join(tmp, "song.csv"))
+            total = [a + b for a, b in zip(total, r)]
+        print("%-24s %9u %9s %12.2f %12.2f" % ("total", total[0], "", 1000 * total[1], 1000 * total[2]))
+        fn = os.path.join(tmp, "synthetic.mid")
+        write_synthetic(fn, int(synthetic))
+        n, binary, csv = measure("synthetic", fn, os.path.join(tmp, "synthetic.csv"))
+        print("synthetic: %.0f notes/s binary, %.0f notes/s csv" % (n / binary, n / csv))
+
+def bench_tracks(tracks = 48, notes = 20000, workers = os.cpu_count()):
+    "Compare decoding the tracks of a large format-1 file one after another and in a process pool"
+    tracks, notes, workers = int(tracks), int(notes), int(workers)
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, "tracks.mid")
+        write_synthetic(fn, notes, tracks = tracks)
+        t0 = time.perf_counter()
+        m = midi.MidiFile(fn, workers = max(workers, 2))     # starts the pool
+        start = time.perf_counter() - t0
+        serial = timed(lambda: midi.MidiFile(fn), 3)
+        parallel = timed(lambda: midi.MidiFile(fn, workers = max(workers, 2)), 3)
+        same = m.notes.tobytes() == midi.MidiFile(fn).notes.tobytes()
+        size = os.path.getsize(fn)
+    print("%u tracks of %u notes (%.1f MB), %u CPUs" % (tracks, notes, size / 2**20, os.cpu_count()))
+    print("serial %.0f ms, %u workers %.0f ms (%.2fx), first call with pool start-up %.0f ms, same notes: %s" %
+        (1000 * serial, max(workers, 2), 1000 * parallel, serial / parallel, 1000 * start, same))
+
+def bench_store(song_dir = midi.SONG_DIR, synthetic = 10**6):
+    "Report load time and memory per note of the columnar note store and of Note objects"
+    def measure(fn):
+        t0 = time.perf_counter()
+        m = midi.MidiFile(fn)
+        load = time.perf_counter() - t0
+        n = max(len(m.notes), 1)
+        tracemalloc.start()
+        m.tracks
+        views = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        old = [DictNote(*r) for r in m.notes[["channel", "pitch", "velocity", "start", "duration", "time", "length"]].tolist()]
+        dicts = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return len(m.notes), load, m.notes.nbytes / n, views / n, dicts / n
+
+    print("%-24s %9s %10s %12s %12s %12s" % ("file", "notes", "load ms", "store B/note", "slots B/note", "dict B/note"))
+    total = [0, 0.]
+    for fn in sorted(glob.glob(song_dir + "/*.mid")):
+        n, load, a, b, c = measure(fn)
+        total[0] += n
+        total[1] += load
+        print("%-24s %9u %10.2f %12.1f %12.1f %12.1f" % (os.path.basename(fn), n, 1000 * load, a, b, c))
+    print("%-24s %9u %10.2f" % ("total", total[0], 1000 * total[1]))
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, "synthetic.mid")
+        write_synthetic(fn, int(synthetic))
+        n, load, a, b, c = measure(fn)
+        print("%-24s %9u %10.2f %12.1f %12.1f %12.1f" % ("synthetic", n, 1000 * load, a, b, c))
+
+class RingingChannel:
+    "Stand-in for a mixer channel whose notes ring for a fixed time on the bench clock"
+
+    def __init__(self, clock, ring_ns):
+        self.clock, self.ring_ns, self.until = clock, ring_ns, 0
+
+    def get_busy(self):
+        return self.clock[0] < self.until
+
+    def play(self, snd):
+        self.until = self.clock[0] + self.ring_ns
+
+def bench_voices(song_dir = midi.SONG_DIR, ring = 500):
+    "Replay every song's notes through the voice pool and check that keys and voices stay paired"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init()
+    clock = [0]
+    perf_counter_ns, audio = midi.time.perf_counter_ns, getattr(midi, "audio", None)
+    # strike() reads the clock through the time module; run it on the bench clock instead
+    midi.time.perf_counter_ns = lambda: clock[0]
+    midi.audio = {x: x for x in range(2, 89)}
+    print("%-32s %8s %8s %8s %8s" % ("file", "notes", "voices", "stolen", "dropped"))
+    try:
+        for fn in sorted(glob.glob(song_dir + "/*.mid")):
+            times, pitches = midi.song_notes(midi.parse_song(fn))
+            pool = midi.VoicePool()
+            pool.resize(midi.polyphony(times))
+            pool.channels = [RingingChannel(clock, int(ring) * 10**6) for ch in pool.channels]
+            midi.stats.update(voices_stolen = 0, notes_dropped = 0)
+            for ms, x in zip(times.tolist(), pitches.tolist()):
+                clock[0] = int(ms * 10**6)
+                pool.strike(x)
+                assert all(pool.owner[i] == x for x, i in pool.keys.items()), (fn, ms)
+                assert all(pool.keys.get(x) == i for i, x in enumerate(pool.owner) if x is not None), (fn, ms)
+            print("%-32s %8u %8u %8u %8u" % (os.path.basename(fn), len(times), len(pool.channels),
+                midi.stats["voices_stolen"], midi.stats["notes_dropped"]))
+    finally:
+        midi.time.perf_counter_ns, midi.audio = perf_counter_ns, audio
+
+if __name__ == "__main__":
+    benches = {
+        "parse": bench_parse,
+        "schedule": bench_schedule,
+        "samples": bench_samples,
+        "sparse": bench_sparse,
+        "startup": bench_startup,
+        "render": bench_render,
+        "roll": bench_roll,
+        "frames": bench_frames,
+        "store": bench_store,
+        "csv": bench_csv,
+        "tracks": bench_tracks,
+        "voices": bench_voices,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benches:
+        print("usage: python bench.py {%s} [args]" % ",".join(benches))
+        sys.exit(1)
+    benches[sys.argv[1]](*sys.argv[2:])
@@ -32,19 +32,30 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import pygame, struct, time, statistics, glob
+import pygame, struct, time, glob, threading, heapq, collections, queue, math, wave, mmap, logging, os, json, signal, re
+import numpy as np
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import songcache
+
+# parser and player diagnostics; silent unless logging is configured, e.g. with MIDI_LOG=debug
+log = logging.getLogger("midi")
 
 class Note(object):
     "Represents a single MIDI note"
     
+    __slots__ = ('channel', 'pitch', 'velocity', 'start', 'duration', 'time', 'length')
     note_names = ['A', 'A#', 'B', 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#']
     
-    def __init__(self, channel, pitch, velocity, start, duration = 0):
+    def __init__(self, channel, pitch, velocity, start, duration = 0, time = 0., length = 0.):
         self.channel = channel
         self.pitch = pitch
         self.velocity = velocity
         self.start = start
         self.duration = duration
+        # onset and length in seconds
+        self.time = time
+        self.length = length
     
     def __str__(self):
         s = Note.note_names[(self.pitch - 9) % 12]
@@ -56,9 +67,201 @@ class Note(object):
     def get_end(self):
         return self.start + self.duration
 
+# A decoded MIDI event. kind is "note_on", "note_off", "tempo", "program", "control" or "meta";
+# a and b are pitch and velocity, microseconds per quarter note and the raw payload,
+# program number, controller number and value, or meta type and payload.
+# time is in seconds and only known for events merged across tracks.
+Event = collections.namedtuple("Event", "tick time track kind channel a b")
+
+# A meta event kept by MidiFile: type is the meta type byte, name its readable name and
+# value the decoded payload (see decode_meta)
+Meta = collections.namedtuple("Meta", "tick track type name value")
+
+meta_names = {0x00: "sequence_number", 0x01: "text", 0x02: "copyright", 0x03: "track_name",
+    0x04: "instrument", 0x05: "lyric", 0x06: "marker", 0x07: "cue_point", 0x20: "channel_prefix",
+    0x21: "port", 0x51: "tempo", 0x54: "smpte_offset", 0x58: "time_signature",
+    0x59: "key_signature", 0x7F: "sequencer"}
+
+major_keys = ['Cb', 'Gb', 'Db', 'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#']
+minor_keys = ['Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 'G#', 'D#', 'A#']
+
+def decode_meta(type, message):
+    """Decode a meta event payload: text events to str, tempo to microseconds per quarter note,
+    time signature to (numerator, denominator, clocks per click, 32nds per quarter),
+    key signature to a name like "G major"; anything else stays bytes"""
+    message = bytes(message)
+    try:
+        if 0x01 <= type <= 0x07:
+            return message.decode('latin-1')
+        if type == 0x51:
+            return struct.unpack('>i', b'\x00' + message)[0]
+        if type == 0x58:
+            n, d, cc, bb = message[:4]
+            return n, 1 << d, cc, bb
+        if type == 0x59:
+            sf, mi = struct.unpack('bB', message[:2])
+            return (minor_keys if mi else major_keys)[sf + 7] + (" minor" if mi else " major")
+        if type == 0x00 or type == 0x20 or type == 0x21:
+            return int.from_bytes(message, 'big')
+    except (ValueError, IndexError, struct.error):
+        pass    # malformed payloads are kept as they are
+    return message
+
+def read_header(data):
+    "Return format, track count, time division and the (start, end) offsets of every MTrk chunk body"
+    if data[:4] != b'MThd': raise Exception('Not a MIDI file')
+    size, format, track_count, division = struct.unpack_from('>ihhh', data, 4)
+    if size != 6: raise Exception('Unusual MIDI file with non-6 sized header')
+    chunks = []
+    pos = 14
+    for i in range(track_count):
+        if data[pos:pos + 4] != b'MTrk': raise Exception('Not a valid track')
+        start = pos + 8
+        pos = start + struct.unpack_from('>i', data, pos + 4)[0]
+        chunks.append((start, pos))
+    return format, track_count, division, chunks
+
+def track_events(data, pos, end, track = 0):
+    "Lazily decode the events of one MTrk chunk body in data[pos:end] as plain tuples in Event field order"
+    tick = 0
+    # To keep track of running status
+    last_flag = None
+    while pos < end:
+        # variable-length delta time
+        delta = data[pos]
+        pos += 1
+        if delta & 0x80:
+            delta &= 0x7F
+            while True:
+                c = data[pos]
+                pos += 1
+                delta = (delta << 7) + (c & 0x7F)
+                if not (c & 0x80): break
+        tick += delta
+
+        flag = data[pos]
+        pos += 1
+        # Sysex and meta messages carry a variable-length payload
+        if flag == 0xF0 or flag == 0xF7 or flag == 0xFF:
+            if flag == 0xFF:
+                type = data[pos]
+                pos += 1
+                if type == 0x2F:    # end of track event
+                    return
+            length = 0
+            while True:
+                c = data[pos]
+                pos += 1
+                length = (length << 7) + (c & 0x7F)
+                if not (c & 0x80): break
+            message = data[pos:pos + length]
+            pos += length
+            if flag != 0xFF: continue
+            if type == 0x51:
+                yield (tick, None, track, "tempo", None, struct.unpack('>i', b'\x00' + message)[0], message)
+            else:
+                yield (tick, None, track, "meta", None, type, message)
+        # MIDI messages
+        else:
+            if flag & 0x80:
+                type_and_channel = last_flag = flag
+                param1 = data[pos]
+                pos += 1
+            else:
+                type_and_channel = last_flag
+                param1 = flag
+            type = type_and_channel >> 4
+            channel = type_and_channel & 0xF
+            if type == 0xC:    # program change
+                yield (tick, None, track, "program", channel, param1, None)
+                continue
+            if type == 0xD:    # channel pressure has no second data byte
+                continue
+            param2 = data[pos]
+            pos += 1
+
+            # a note-on with velocity 0 is an off
+            if type == 0x9 and param2:
+                yield (tick, None, track, "note_on", channel, param1, param2)
+            elif type == 0x8 or type == 0x9:
+                yield (tick, None, track, "note_off", channel, param1, param2)
+            elif type == 0xB:
+                yield (tick, None, track, "control", channel, param1, param2)
+
+def iter_events(file_name, merged = True):
+    """Lazily decode the events of a MIDI file, memory-mapped so that memory use stays bounded.
+    Events come track by track, or with merged set, in time order across tracks with times in seconds."""
+    with open(file_name, 'rb') as file, mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        format, track_count, division, chunks = read_header(data)
+        tracks = [track_events(data, start, end, n) for n, (start, end) in enumerate(chunks)]
+        if not merged:
+            for events in tracks:
+                for e in events:
+                    yield Event._make(e)
+            return
+        # seconds are summed up segment by segment as tempo events arrive
+        seg_tick, seg_time, usec = 0, 0., 500000
+        for e in heapq.merge(*tracks, key = lambda e: e[0]):
+            tick = e[0]
+            time = seg_time + (tick - seg_tick) * usec / (1e6 * division)
+            if e[3] == "tempo":
+                seg_tick, seg_time, usec = tick, time, e[5]
+            yield Event(tick, time, *e[2:])
+
+def decode_track(data, start, end):
+    """Decode the notes of one MTrk chunk body in data[start:end] into columns (start and end in ticks),
+    returning them with the track's tempo, meta and program events as (tick, kind, channel, a, b)"""
+    c = {"pitch": array('B'), "velocity": array('B'), "channel": array('B'), "start": array('q'), "end": array('q')}
+    pitches, starts, ends = c["pitch"], c["start"], c["end"]
+    events = []
+    # Open notes keyed by (channel, pitch), stacked for overlapping re-strikes
+    active = {}
+    for tick, _, _, kind, channel, a, b in track_events(data, start, end):
+        if kind == "note_on":
+            active.setdefault((channel, a), []).append(len(pitches))
+            pitches.append(a)
+            c["velocity"].append(b)
+            c["channel"].append(channel)
+            starts.append(tick)
+            ends.append(tick)
+        elif kind == "note_off":
+            stack = active.get((channel, a))
+            if stack:
+                ends[stack.pop()] = tick
+        elif kind != "control":
+            events.append((tick, kind, channel, a, b))
+    return c, events
+
+def decode_file_track(job):
+    "Process pool job: decode the MTrk chunk body at (start, end) of a MIDI file"
+    file_name, start, end = job
+    with open(file_name, 'rb') as file, mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        return decode_track(data, start, end)
+
+decoder_pools = {}  # worker count -> process pool for decoding tracks, kept for the next file
+
+def tick_seconds(ticks, division, tempo_map):
+    "Convert an array of tick positions to seconds using a list of (tick, microseconds per quarter note)"
+    div = float(division)
+    ticks = np.asarray(ticks, dtype = float)
+    tmap = sorted(tempo_map, key = lambda e: e[0])
+    if not tmap or tmap[0][0] > 0:
+        tmap.insert(0, (0, 500000))     # 120 bpm until the first tempo event
+    seg_tick = np.array([e[0] for e in tmap], dtype = float)
+    seg_us = np.array([e[1] for e in tmap], dtype = float)
+    # time at which each tempo segment begins
+    seg_sec = np.concatenate(([0.], np.cumsum(np.diff(seg_tick) * seg_us[:-1]))) / (1e6 * div)
+    # with several tempo events at one tick the last one wins
+    i = np.searchsorted(seg_tick, ticks, 'right') - 1
+    return seg_sec[i] + (ticks - seg_tick[i]) * seg_us[i] / (1e6 * div)
+
 class MidiFile(object):
     "Represents the notes in a MIDI file"
     
+    # one record per note in the columnar note store; start and duration are in beats, time and length in seconds
+    note_dtype = np.dtype([("pitch", np.uint8), ("velocity", np.uint8), ("channel", np.uint8), ("track", np.uint16),
+        ("start", np.float64), ("duration", np.float64), ("time", np.float64), ("length", np.float64)])
+
     def read_byte(self, file):
         return struct.unpack('B', file.read(1))[0]
     
@@ -77,93 +280,182 @@ class MidiFile(object):
         
         return (num, counter)
     
-    def __init__(self, file_name):
+    def __init__(self, file_name, bulk = True, workers = 0):
         self.tempo = 120
+        self.file_name = file_name
+        self.track_count = 0
+        self.notes = np.zeros(0, dtype = MidiFile.note_dtype)
+        self._tracks = None
+        # (tick, microseconds per quarter note) for every tempo change
+        self.tempo_map = []
+        # every meta event other than end of track, as Meta tuples in file order
+        self.meta = []
+        # per-note columns the parser appends to; start and end are in ticks
+        self.columns = {"pitch": array('B'), "velocity": array('B'), "channel": array('B'),
+            "track": array('H'), "start": array('q'), "end": array('q')}
         try:
-            file = open(file_name, 'rb')
-            if file.read(4) != b'MThd': raise Exception('Not a MIDI file')
-            self.file_name = file_name
-            size = struct.unpack('>i', file.read(4))[0]
-            if size != 6: raise Exception('Unusual MIDI file with non-6 sized header')
-            self.format = struct.unpack('>h', file.read(2))[0]
-            self.track_count = struct.unpack('>h', file.read(2))[0]
-            self.time_division = struct.unpack('>h', file.read(2))[0]
+            with open(file_name, 'rb') as file:
+                if bulk:
+                    self.parse_buffer(file.read(), workers)
+                else:
+                    self.parse_stream(file)
+            self.build_store()
+        except Exception as e:
+            log.error("Cannot parse MIDI file %s: %s", file_name, e)
+        del self.columns
+
+    @property
+    def tracks(self):
+        "The notes of every track as Note objects, made from the note store on first use"
+        if self._tracks is None:
+            self._tracks = [[] for i in range(self.track_count)]
+            for r in self.notes.tolist():
+                self._tracks[r[3]].append(Note(r[2], r[0], r[1], r[4], r[5], r[6], r[7]))
+        return self._tracks
+
+    @property
+    def track_names(self):
+        "The name of every track, or None for tracks without one"
+        names = [None] * self.track_count
+        for m in self.meta:
+            if m.type == 0x03 and names[m.track] is None:
+                names[m.track] = m.value
+        return names
+
+    def meta_event(self, tick, track, type, message):
+        "Keep a meta event, following tempo changes"
+        value = decode_meta(type, message)
+        self.meta.append(Meta(tick, track, type, meta_names.get(type, "unknown"), value))
+        if type == 0x51 and isinstance(value, int):    # qpm/bpm
+            # http://www.recordingblogs.com/sa/Wiki?topic=MIDI+Set+Tempo+meta+message
+            self.tempo_map.append((tick, value))
+            self.tempo = 6e7 / value
+        log.debug("track %u, tick %u: meta 0x%02X %s = %r", track, tick, type, meta_names.get(type, "unknown"), value)
+
+    def seconds(self, beats):
+        "Convert an array of beat positions to seconds using the tempo map"
+        return tick_seconds(np.asarray(beats, dtype = float) * self.time_division, self.time_division, self.tempo_map)
 
-            # Now to fill out the arrays with the notes
-            self.tracks = []
-            for i in range(0, self.track_count):
-                self.tracks.append([])
+    def build_store(self):
+        "Turn the parsed columns into the note store, timing every note through the tempo map"
+        c = self.columns
+        notes = np.zeros(len(c["pitch"]), dtype = MidiFile.note_dtype)
+        if len(notes):
+            for f in ("pitch", "velocity", "channel", "track"):
+                notes[f] = c[f]
+            div = float(self.time_division)
+            start = np.frombuffer(c["start"], dtype = np.int64) / div
+            end = np.frombuffer(c["end"], dtype = np.int64) / div
+            notes["start"] = start
+            notes["duration"] = end - start
+            notes["time"] = self.seconds(start)
+            notes["length"] = self.seconds(end) - notes["time"]
+        self.notes = notes
 
-            for nn, track in enumerate(self.tracks):
-                abs_time = 0.
+    def parse_buffer(self, data, workers = 0):
+        "Decode a complete MIDI file held in memory, with more than one worker process decoding its tracks in parallel"
+        self.format, self.track_count, self.time_division, chunks = read_header(data)
+        c = self.columns
 
-                if file.read(4) != b'MTrk': raise Exception('Not a valid track')
-                size = struct.unpack('>i', file.read(4))[0]
+        if workers > 1 and len(chunks) > 1:
+            if workers not in decoder_pools:
+                decoder_pools[workers] = ProcessPoolExecutor(workers)
+            # workers map the file themselves, so only the chunk offsets are sent to them
+            jobs = [(self.file_name, start, end) for start, end in chunks]
+            tracks = decoder_pools[workers].map(decode_file_track, jobs)
+        else:
+            tracks = (decode_track(data, start, end) for start, end in chunks)
+        # tracks come back in file order, so the note store is the same either way
+        for nn, (columns, events) in enumerate(tracks):
+            for f, column in columns.items():
+                c[f].extend(column)
+            c["track"].extend(array('H', [nn]) * len(columns["pitch"]))
+            for tick, kind, channel, a, b in events:
+                if kind == "tempo":
+                    self.meta_event(tick, nn, 0x51, b)
+                elif kind == "meta":
+                    self.meta_event(tick, nn, a, b)
+                elif kind == "program":
+                    log.debug("track %u, tick %u: program change, channel %u = %u", nn, tick, channel, a)
 
-                # To keep track of running status
-                last_flag = None
-                while size > 0:
-                    delta, size = self.read_variable_length(file, size)
-                    delta /= float(self.time_division)
-                    abs_time += delta
+    def parse_stream(self, file):
+        "Decode a MIDI file one byte at a time from an open file object"
+        if file.read(4) != b'MThd': raise Exception('Not a MIDI file')
+        size = struct.unpack('>i', file.read(4))[0]
+        if size != 6: raise Exception('Unusual MIDI file with non-6 sized header')
+        self.format = struct.unpack('>h', file.read(2))[0]
+        self.track_count = struct.unpack('>h', file.read(2))[0]
+        self.time_division = struct.unpack('>h', file.read(2))[0]
+        c = self.columns
 
+        for nn in range(self.track_count):
+            ticks = 0
+
+            if file.read(4) != b'MTrk': raise Exception('Not a valid track')
+            size = struct.unpack('>i', file.read(4))[0]
+
+            # To keep track of running status
+            last_flag = None
+            # Open notes keyed by (channel, pitch), stacked for overlapping re-strikes
+            active = {}
+            while size > 0:
+                delta, size = self.read_variable_length(file, size)
+                ticks += delta
+
+                size -= 1
+                flag = self.read_byte(file)
+                # Sysex messages
+                if flag == 0xF0 or flag == 0xF7:
+                    # print "Sysex"
+                    while True:
+                        size -= 1
+                        if self.read_byte(file) == 0xF7: break
+                # Meta messages
+                elif flag == 0xFF:
                     size -= 1
-                    flag = self.read_byte(file)
-                    # Sysex messages
-                    if flag == 0xF0 or flag == 0xF7:
-                        # print "Sysex"
-                        while True:
-                            size -= 1
-                            if self.read_byte(file) == 0xF7: break
-                    # Meta messages
-                    elif flag == 0xFF:
+                    type = self.read_byte(file)
+                    if type == 0x2F:    # end of track event
+                        self.read_byte(file)
                         size -= 1
-                        type = self.read_byte(file)
-                        if type == 0x2F:    # end of track event
-                            self.read_byte(file)
-                            size -= 1
-                            break
-                        print("Meta: " + str(type))
-                        length, size = self.read_variable_length(file, size)
-                        message = file.read(length)
-                        # if type not in [0x0, 0x7, 0x20, 0x2F, 0x51, 0x54, 0x58, 0x59, 0x7F]:
-                        print(length, message)
-                        if type == 0x51:    # qpm/bpm
-                            # http://www.recordingblogs.com/sa/Wiki?topic=MIDI+Set+Tempo+meta+message
-                            self.tempo = 6e7 / struct.unpack('>i', b'\x00' + message)[0]
-                            print("tempo =", self.tempo, "bpm")
-                    # MIDI messages
-                    else:
-                        if flag & 0x80:
-                            type_and_channel = flag
-                            size -= 1
-                            param1 = self.read_byte(file)
-                            last_flag = flag
-                        else:
-                            type_and_channel = last_flag
-                            param1 = flag
-                        type = ((type_and_channel & 0xF0) >> 4)
-                        channel = type_and_channel & 0xF
-                        if type == 0xC:    # detect MIDI program change
-                            print("program change, channel", channel, "=", param1)
-                            continue
+                        break
+                    length, size = self.read_variable_length(file, size)
+                    message = file.read(length)
+                    self.meta_event(ticks, nn, type, message)
+                # MIDI messages
+                else:
+                    if flag & 0x80:
+                        type_and_channel = flag
                         size -= 1
-                        param2 = self.read_byte(file)
-                        
-                        # detect MIDI ons and MIDI offs
-                        if type == 0x9:
-                            track.append(Note(channel, param1, param2, abs_time))
-                        elif type == 0x8:
-                            for note in reversed(track):
-                                if note.channel == channel and note.pitch == param1:
-                                    note.duration = abs_time - note.start
-                                    break
+                        param1 = self.read_byte(file)
+                        last_flag = flag
+                    else:
+                        type_and_channel = last_flag
+                        param1 = flag
+                    type = ((type_and_channel & 0xF0) >> 4)
+                    channel = type_and_channel & 0xF
+                    if type == 0xC:    # detect MIDI program change
+                        log.debug("track %u, tick %u: program change, channel %u = %u", nn, ticks, channel, param1)
+                        continue
+                    if type == 0xD:    # channel pressure has no second data byte
+                        continue
+                    size -= 1
+                    param2 = self.read_byte(file)
+
+                    # detect MIDI ons and MIDI offs (a note-on with velocity 0 is an off)
+                    if type == 0x9 and param2:
+                        active.setdefault((channel, param1), []).append(len(c["pitch"]))
+                        c["pitch"].append(param1)
+                        c["velocity"].append(param2)
+                        c["channel"].append(channel)
+                        c["track"].append(nn)
+                        c["start"].append(ticks)
+                        c["end"].append(ticks)
+                    elif type == 0x8 or type == 0x9:
+                        stack = active.get((channel, param1))
+                        if stack:
+                            c["end"][stack.pop()] = ticks
+
 
-        except Exception as e:
-            print("Cannot parse MIDI file: " + str(e))
-        finally:
-            file.close()
-    
     def __str__(self):
         s = ""
         for i, track in enumerate(self.tracks):
@@ -176,125 +468,989 @@ class MidiFile(object):
 RES = 650, 440
 BACKGROUND = 100, 100, 100
 TARGET_FPS = 60     # FPS that PyGame is expcted to run at
+SCROLL = 0.12       # piano roll pixels per millisecond of song time
+PRERENDER = False   # draw each song's whole piano roll at load time, showing notes ahead of the playhead
+PLAYHEAD = 0.75     # with PRERENDER, the playhead position as a fraction of the window width
+TILE = 4096         # with PRERENDER, the width of one piano roll tile in pixels
+LOOKAHEAD = 50      # hand notes to the scheduler this many milliseconds before they are due
+SEEK_MS = 10000     # how far Page Up and Page Down jump in the song
+TRACE_SIZE = 1 << 16    # timed phases kept for the frame trace, about ten per frame
+HISTOGRAM = 120, 60     # size of the frame time histogram overlay
+SAMPLE_CAP = 4 << 20    # bytes of decoded samples to keep before evicting
+SAMPLE_RATE = 44100     # rate of the midisnd samples
+SAMPLE_STEP = 1         # keep the sample of every Nth key only and pitch-shift it for the keys between
+SAMPLE_PACK = songcache.CACHE_DIR   # directory for all samples packed as raw PCM, None to decode the WAV files
+VOLUME = 0.2
+VOICE_MS = 500      # how long a struck sample sounds
+MAX_VOICES = 64     # most mixer channels to allocate
+STEAL_MS = 30       # drop a note rather than steal a voice younger than this
+SOFT_MIX = False    # mix notes into PCM blocks in a thread of its own and stream them through one channel
+MIX_BLOCK = 512     # with SOFT_MIX, frames per mixed block; notes must reach the mixer two blocks before they are due
 SONG_DIR = "goldberg"
+SONG_CACHE = songcache.CACHE_DIR    # directory for parsed songs, None to always parse
+PARSE_WORKERS = 0   # processes to decode the tracks of a MIDI file in parallel, 0 for none
+
+# flattened note records of a song, as stored in the song cache
+NOTE_DTYPE = np.dtype([("pitch", np.uint8), ("time", np.float64), ("duration", np.float64),
+    ("velocity", np.uint8), ("channel", np.uint8)])
+
+# per-frame instrumentation counters
+stats = {"frames": 0, "scan_ns": 0, "scan_total_ns": 0, "jitter_ns": [], "load_frames": 0,
+    "schedule_ns": 0, "draw_ns": 0, "flip_ns": 0, "voices_stolen": 0, "notes_dropped": 0}
+
+class Trace:
+    "Ring buffer of timed phases of the frame loop, written out in Chrome trace format"
+
+    def __init__(self, size = TRACE_SIZE):
+        self.ring = [None] * size
+        self.n = 0      # phases recorded so far
+
+    def add(self, name, t0, t1):
+        "Record that phase name ran from t0 to t1 (ns)"
+        self.ring[self.n % len(self.ring)] = (name, t0, t1)
+        self.n += 1
+
+    def phases(self):
+        "The recorded phases, oldest first"
+        i = self.n % len(self.ring)
+        return [p for p in self.ring[i:] + self.ring[:i] if p is not None]
+
+    def dump(self, fn):
+        "Write the recorded phases as a Chrome trace JSON file, for chrome://tracing or Perfetto"
+        events = [{"name": name, "ph": "X", "ts": t0 / 1e3, "dur": (t1 - t0) / 1e3, "pid": 1, "tid": 1}
+            for name, t0, t1 in self.phases()]
+        with open(fn, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+trace = Trace()
+
+class NoteScheduler(threading.Thread):
+    "Fires queued notes at their due time on the monotonic clock"
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon = True)
+        self.queue = []     # heap of (due time in ns, sample number)
+        self.cond = threading.Condition()
+
+    def add(self, due, x):
+        with self.cond:
+            heapq.heappush(self.queue, (due, x))
+            self.cond.notify()
+
+    def clear(self):
+        "Drop the queued notes and return how many there were"
+        with self.cond:
+            n = len(self.queue)
+            self.queue = []
+        return n
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait()
+                    continue
+                due, x = self.queue[0]
+                wait = due - time.perf_counter_ns()
+                if wait > 0:
+                    self.cond.wait(wait / 1e9)
+                    continue
+                heapq.heappop(self.queue)
+            strike(x)
+            stats["jitter_ns"].append(time.perf_counter_ns() - due)
+
+class Mixer(threading.Thread):
+    "Mixes queued notes into PCM blocks on its own clock and streams them through one mixer channel"
+
+    def __init__(self, block = MIX_BLOCK):
+        threading.Thread.__init__(self, daemon = True)
+        self.block = block
+        self.queue = []     # heap of (due time in ns, sample number)
+        self.cond = threading.Condition()
+        self.samples = {}   # sample number -> float array at the mixer rate, decoded on first use
+        self.voices = {}    # sample number -> [sample, frames played]; a re-struck key cuts off its last note
+        self.blocks = 0
+        self.underruns = 0
+        self.peak = 0       # most voices mixed into one block
+
+    def add(self, due, x):
+        with self.cond:
+            heapq.heappush(self.queue, (due, x))
+            self.cond.notify()
+
+    def clear(self):
+        "Drop the queued notes and return how many there were"
+        with self.cond:
+            n = len(self.queue)
+            self.queue = []
+        return n
+
+    def sample(self, x):
+        a = self.samples.get(x)
+        if a is None:
+            a = read_sample(x, SAMPLE_STEP) * VOLUME
+            if self.freq != SAMPLE_RATE:
+                a = shift(a, 12 * math.log2(SAMPLE_RATE / self.freq))
+            self.samples[x] = a
+        return a
+
+    def mix(self, start):
+        "Return the block of audio that begins playing at start (ns) as a Sound"
+        n = self.block
+        end = start + n * 1e9 / self.freq
+        due = []
+        with self.cond:
+            while self.queue and self.queue[0][0] < end:
+                due.append(heapq.heappop(self.queue))
+        for d, x in due:
+            # onsets fall on the frame they are due at; notes handed over too late start right away
+            off = max(0, round((d - start) * self.freq / 1e9))
+            self.voices[x] = [self.sample(x), -off]
+            stats["jitter_ns"].append(start + off * 1e9 / self.freq - d)
+        out = np.zeros(n, dtype = np.float32)
+        self.peak = max(self.peak, len(self.voices))
+        for x, v in list(self.voices.items()):
+            a, pos = v
+            off = max(-pos, 0)
+            seg = a[pos + off:pos + n]
+            out[off:off + len(seg)] += seg
+            if pos + n >= len(a):
+                del self.voices[x]
+            else:
+                v[1] = pos + n
+        np.clip(out, -1, 1, out = out)
+        if self.dtype == np.int16:
+            out = out * 32767
+        pcm = np.repeat(out.astype(self.dtype)[:, None], self.channels, axis = 1)
+        self.blocks += 1
+        return pygame.sndarray.make_sound(pcm)
+
+    def run(self):
+        self.freq, fmt, self.channels = pygame.mixer.get_init()
+        self.dtype = np.int16 if fmt == -16 else np.float32
+        channel = pygame.mixer.Channel(0)
+        block_ns = self.block * 1e9 / self.freq
+        poll_ns = block_ns / 8
+        start = 0       # when the next block begins playing, in ns
+        streaming = False
+        while True:
+            now = time.perf_counter_ns()
+            with self.cond:
+                # with nothing sounding or due soon, let the stream run dry
+                if not self.voices and (not self.queue or self.queue[0][0] > now + 2 * block_ns):
+                    streaming = False
+                    self.cond.wait(self.block / self.freq / 2)
+                    continue
+            if not channel.get_busy():
+                if streaming:
+                    self.underruns += 1
+                start = now
+                channel.play(self.mix(start))
+                streaming = True
+            elif streaming and channel.get_queue() is None:
+                # the block queued last began within the last poll, so this one follows it;
+                # pull the estimate towards that so it follows the sound card's clock
+                start += (now + block_ns - poll_ns / 2 - start) / 8
+                channel.queue(self.mix(start))
+            else:
+                # wait for the queued block to begin, or for the end of the stream that ran dry
+                time.sleep(poll_ns / 1e9)
+                continue
+            start += block_ns
+
+scheduler = Mixer() if SOFT_MIX else NoteScheduler()
+clock_ns = None     # wall-clock time of the last play() in ns
+
+def sample_file(x):
+    "Path of the WAV file for sample number x"
+    # samples are numbered with middle C == 39 (i.e. off by one)
+    return "midisnd/midi%02u.wav" % (x - 1)
+
+def sample_key(x, step = SAMPLE_STEP):
+    "Sample number whose sample is pitch-shifted to play x when only every step-th key is kept"
+    return min(2 + round((x - 2) / step) * step, 2 + (88 - 2) // step * step)
+
+def shift(a, semitones):
+    "Resample a sample array (frames first) to sound semitones higher at the same rate"
+    ratio = 2 ** (semitones / 12)
+    pos = np.arange(0, len(a) - 1, ratio)
+    idx = np.arange(len(a))
+    if a.ndim == 1:
+        out = np.interp(pos, idx, a)
+    else:
+        out = np.stack([np.interp(pos, idx, a[:, i]) for i in range(a.shape[1])], axis = 1)
+    if np.issubdtype(a.dtype, np.integer):
+        out = np.rint(out)
+    return out.astype(a.dtype)
+
+def read_sample(x, step = 1):
+    "Decode the sample for sample number x into a mono float array without using the mixer"
+    key = sample_key(x, step)
+    with wave.open(sample_file(key)) as w:
+        a = np.frombuffer(w.readframes(w.getnframes()), dtype = '<i2')
+        a = a.reshape(-1, w.getnchannels()).mean(axis = 1, dtype = np.float32) / 32768
+    return a if key == x else shift(a, x - key)
+
+def read_samples():
+    "Decode all samples into mono float arrays without using the mixer"
+    return {x: read_sample(x) for x in range(2, 89)}
+
+def mix(song, samples, rate = SAMPLE_RATE, volume = VOLUME):
+    "Mix the notes of a NOTE_DTYPE array into a mono float buffer like the live player would"
+    times, pitches = song["time"], song["pitch"].astype(np.int64) - 20
+    onsets = np.round((times - (times.min() if len(times) else 0)) * rate).astype(np.int64)
+    has = np.isin(pitches, list(samples))
+    if not has.all():
+        # e.g. A0 or drum notes below the piano's range
+        log.warning("%u notes without a sample skipped", (~has).sum())
+        onsets, pitches = onsets[has], pitches[has]
+    length = max([o + len(samples[x]) for o, x in zip(onsets.tolist(), pitches.tolist())], default = 0)
+    buf = np.zeros(length, dtype = np.float32)
+    for x in np.unique(pitches).tolist():
+        snd = samples[x] * volume
+        on = np.sort(onsets[pitches == x])
+        # a re-struck key cuts off its previous note, as audio[x].stop() does
+        ends = np.minimum(on + len(snd), np.append(on[1:], length))
+        for a, b in zip(on.tolist(), ends.tolist()):
+            buf[a:b] += snd[:b - a]
+    return buf
+
+# packed samples: magic, version, rate, format and channels of the mixer, sample count,
+# then (sample number, offset, bytes) for every sample and the raw PCM data
+PACK_HEADER = struct.Struct('<4sHiiHH')
+PACK_ENTRY = struct.Struct('<Hqq')
+
+def pack_path(pack_dir):
+    "Path of the sample pack for the mixer's current format"
+    freq, fmt, channels = pygame.mixer.get_init()
+    return os.path.join(pack_dir, "samples-%u-%s%u-%u.pcm" % (freq, "s" if fmt < 0 else "u", abs(fmt), channels))
+
+def pack_samples(path):
+    "Decode every sample to the mixer's format once and store them all in one raw PCM file with an offset table"
+    freq, fmt, channels = pygame.mixer.get_init()
+    raws = [(x, pygame.mixer.Sound(sample_file(x)).get_raw()) for x in range(2, 89)]
+    pos = PACK_HEADER.size + PACK_ENTRY.size * len(raws)
+    table = []
+    for x, raw in raws:
+        table.append(PACK_ENTRY.pack(x, pos, len(raw)))
+        pos += len(raw)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    tmp = "%s.%u.%u.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(PACK_HEADER.pack(b'MSND', 1, freq, fmt, channels, len(raws)))
+            f.write(b''.join(table))
+            for x, raw in raws:
+                f.write(raw)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def read_pack(path):
+    "Memory-map a sample pack; return None unless it is complete and matches the mixer's format"
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None     # missing or empty
+    if len(data) < PACK_HEADER.size:
+        return None
+    magic, version, freq, fmt, channels, count = PACK_HEADER.unpack_from(data)
+    if magic != b'MSND' or version != 1 or (freq, fmt, channels) != pygame.mixer.get_init():
+        return None
+    if PACK_HEADER.size + count * PACK_ENTRY.size > len(data):
+        return None
+    table = {}
+    for i in range(count):
+        x, offset, n = PACK_ENTRY.unpack_from(data, PACK_HEADER.size + i * PACK_ENTRY.size)
+        if offset + n > len(data):
+            return None     # cut short, e.g. by a full disk
+        table[x] = offset, n
+    if set(table) != set(range(2, 89)):
+        return None
+    return data, table
+
+def open_pack(pack_dir):
+    "Memory-map the sample pack for the mixer's format, building it if it is missing or older than a sample"
+    path = pack_path(pack_dir)
+    try:
+        built = os.stat(path).st_mtime_ns
+    except OSError:
+        built = None
+    pack = None
+    if built is not None and all(os.stat(sample_file(x)).st_mtime_ns <= built for x in range(2, 89)):
+        pack = read_pack(path)
+    if pack is None:
+        # missing, stale or damaged
+        try:
+            pack_samples(path)
+        except OSError:
+            return None     # without a writable cache the WAV files still work
+        pack = read_pack(path)
+    return pack
+
+class SampleBank:
+    "Piano samples decoded on first use and evicted least recently used first"
+
+    def __init__(self, cap = SAMPLE_CAP, step = SAMPLE_STEP, pack = SAMPLE_PACK):
+        self.cap = cap
+        self.step = step
+        self.pack = open_pack(pack) if pack else None   # (memory map, {sample number: (offset, bytes)})
+        self.size = 0       # bytes of decoded sample data held
+        self.loads = 0
+        self.evictions = 0
+        self.sounds = collections.OrderedDict()
+        self.sources = {}   # with step > 1, the kept samples as mixer-format arrays to resample from
+        self.source_size = 0
+        self.lock = threading.Lock()    # the note scheduler thread looks up samples too
+
+    def load(self, x):
+        "Decode the sample for sample number x, or make it from the nearest kept sample"
+        if self.step == 1:
+            snd = self.sound(x)
+        else:
+            key = sample_key(x, self.step)
+            src = self.sources.get(key)
+            if src is None:
+                src = self.sources[key] = pygame.sndarray.array(self.sound(key))
+                self.source_size += src.nbytes
+            snd = pygame.sndarray.make_sound(src if key == x else shift(src, x - key))
+        snd.set_volume(VOLUME)
+        self.loads += 1
+        return snd
+
+    def sound(self, x):
+        "A Sound of sample number x, from the sample pack if there is one"
+        if self.pack is None:
+            return pygame.mixer.Sound(sample_file(x))
+        data, table = self.pack
+        offset, n = table[x]
+        # pygame copies the samples into a buffer of its own, but there is nothing left to parse or convert
+        return pygame.mixer.Sound(buffer = memoryview(data)[offset:offset + n])
+
+    def full_size(self):
+        "Bytes the samples of all 87 keys take once decoded to the mixer format"
+        freq, fmt, channels = pygame.mixer.get_init()
+        n = 0
+        for x in range(2, 89):
+            with wave.open(sample_file(x)) as w:
+                n += int(w.getnframes() * freq / w.getframerate())
+        return n * channels * (abs(fmt) // 8)
+
+    def nbytes(self, snd):
+        freq, fmt, channels = pygame.mixer.get_init()
+        return int(snd.get_length() * freq) * channels * (abs(fmt) // 8)
+
+    def __getitem__(self, x):
+        with self.lock:
+            snd = self.sounds.get(x)
+            if snd is not None:
+                self.sounds.move_to_end(x)
+                return snd
+            snd = self.sounds[x] = self.load(x)
+            self.size += self.nbytes(snd)
+            while self.size > self.cap and len(self.sounds) > 1:
+                y, old = self.sounds.popitem(last = False)
+                self.size -= self.nbytes(old)
+                self.evictions += 1
+            return snd
+
+    def preload(self, pitches):
+        "Decode ahead of time the samples a song will need"
+        for x in sorted(set(pitches)):
+            self[x]
 
 def ini(s, res):
-    "Load samples"
-    global audio
-
-    audio = {}
-    for n in range(2, 89):
-            # samples are numbered with middle C == 39 (i.e. off by one)
-            audio[n] = pygame.mixer.Sound("midisnd/midi%02u.wav" % (n - 1))
-            audio[n].set_volume(0.2)
-
-def load_song(s, res, fn):
-    "Load song data"
-    global notes, t, inc, first, last
-
-    notes = []
-    first, last = 1e9, -1
-    m = MidiFile(fn)
-    for tn in range(len(m.tracks)):
-        for n in m.tracks[tn]:
-            if n.velocity > 0:
-                tt = int(1000 * n.start)
-                first = min(first, tt)
-                last = max(last, tt)
-                notes.append([n.pitch - 20, tt])
-    inc = 20    # advance by this many MIDI time units during each PyGame frame
-    t = 0
-    #print(notes)
-
-def play(s, res, fpsfac, tfac):
-    "Play all notes that should trigger during this PyGame frame"
-    global t
-    s.scroll(dx = -2)
-    pygame.draw.rect(s, BACKGROUND, [RES[0]-2, 0, 2, RES[1]])
-    # apply user tempo selection and FPS adjustment
-    rinc = int(inc * fpsfac * tfac)
-    for x, y in notes:
-        if t <= y-first < t + rinc:
-            audio[x].stop()
-            audio[x].play()
-            pygame.draw.rect(s, (255,255,255), [RES[0]-2, RES[1]-5*x, 2, 2])
-            #print(y, x)
-    t += rinc
+    "Set up the sample bank, the voices and the piano roll; samples are loaded as songs need them"
+    global audio, voices
+
+    # the software mixer decodes and keeps the samples it plays itself
+    audio = voices = None
+    if not SOFT_MIX:
+        audio = SampleBank()
+        voices = VoicePool()
+    roll_init(res)
+
+def roll_init(res):
+    "Create the piano roll ring buffer"
+    global roll, col, band, dirty, tiles
+
+    roll = pygame.Surface(res)
+    roll.fill(BACKGROUND)
+    col = 0                 # next column to be written; the oldest visible column
+    band = [res[1], 0]      # rows that have ever held a note; the rest stays background
+    dirty = False
+    tiles = None            # whole-song tiles when PRERENDER is set
+
+def prerender(res):
+    "With PRERENDER set, rasterize the whole song into piano roll tiles"
+    global tiles
+    tiles = None
+    if not PRERENDER: return
+    w, h = res
+    xs = (note_time * SCROLL).astype(np.int64)
+    ys = h - h * note_pitch // 88
+    tiles = []
+    for x0 in range(0, int(xs.max()) + 2 if len(xs) else 1, TILE):
+        tile = pygame.Surface((TILE, h))
+        tile.fill(BACKGROUND)
+        white = tile.map_rgb((255,255,255))
+        pixels = pygame.surfarray.pixels2d(tile)
+        # every note is a 2x2 block, which may start in the previous tile
+        sel = (xs >= x0 - 1) & (xs < x0 + TILE)
+        for dx in (0, 1):
+            for dy in (0, 1):
+                cx, cy = xs[sel] - x0 + dx, ys[sel] + dy
+                ok = (cx >= 0) & (cx < TILE) & (cy < h)
+                pixels[cx[ok], cy[ok]] = white
+        del pixels  # unlock the surface
+        tiles.append(tile)
+    if len(ys):
+        band[0] = min(band[0], int(ys.min()))
+        band[1] = max(band[1], int(ys.max()) + 2)
+
+def roll_advance(res, px):
+    "Move the write column of the piano roll on by px columns, clearing them"
+    global col, dirty
+    w, h = res
+    px = min(px, w)
+    pygame.draw.rect(roll, BACKGROUND, [col, 0, px, h])
+    if col + px > w:
+        pygame.draw.rect(roll, BACKGROUND, [0, 0, col + px - w, h])
+    col = (col + px) % w
+    dirty = True
+
+def roll_note(res, x, back = 0):
+    "Mark sample number x at the newest column of the piano roll, or back columns before it"
+    global dirty
+    w, h = res
+    y = h - h * x // 88
+    c = (col - 2 - back) % w
+    pygame.draw.rect(roll, (255,255,255), [c, y, 2, 2])
+    if c + 2 > w:
+        pygame.draw.rect(roll, (255,255,255), [c - w, y, 2, 2])
+    band[0] = min(band[0], y)
+    band[1] = max(band[1], y + 2)
+    dirty = True
+
+def roll_redraw(res):
+    "Rebuild the piano roll ring buffer as if the song had played up to the current position"
+    global col, dirty
+    w, h = res
+    roll.fill(BACKGROUND)
+    col = 0
+    # notes are drawn when they are handed to the scheduler, LOOKAHEAD ms before they are due
+    lo = int(np.searchsorted(note_time, (scrolled - w) / SCROLL + LOOKAHEAD))
+    for y, x in zip(note_time[lo:cursor].tolist(), note_pitch[lo:cursor].tolist()):
+        back = scrolled - max(int((y - LOOKAHEAD) * SCROLL), 0)
+        if back < w - 2:
+            roll_note(res, x, back)
+    dirty = True
+
+def present(s, res):
+    "Copy the piano roll to the screen and return the rectangles that changed"
+    global dirty
+    if not dirty or band[0] >= band[1]:
+        return []
+    dirty = False
+    w, h = res
+    top, height = band[0], band[1] - band[0]
+    if tiles is None:
+        # the ring buffer is unrolled with its oldest column at the left edge
+        s.blit(roll, (0, top), [col, top, w - col, height])
+        s.blit(roll, (w - col, top), [0, top, col, height])
+    else:
+        # show the part of the song around the playhead, clearing only what the tiles do not cover
+        head = int(w * PLAYHEAD)
+        x0 = head - scrolled
+        x1 = x0 + len(tiles) * TILE
+        if x0 > 0:
+            s.fill(BACKGROUND, [0, top, min(x0, w), height])
+        if x1 < w:
+            s.fill(BACKGROUND, [max(x1, 0), top, w - max(x1, 0), height])
+        for i, tile in enumerate(tiles):
+            x = x0 + i * TILE
+            if -TILE < x < w:
+                s.blit(tile, (x, top), [0, top, TILE, height])
+        pygame.draw.line(s, (140,140,140), (head, top), (head, top + height - 1))
+    return [pygame.Rect(0, top, w, height)]
+
+class VoicePool:
+    "Mixer channels handed out to notes, stealing the oldest voice when all are busy"
+
+    def __init__(self):
+        self.channels = []
+        self.lock = threading.Lock()    # notes are struck from the scheduler thread
+
+    def resize(self, n):
+        "Allocate n mixer channels"
+        with self.lock:
+            n = max(1, min(n, MAX_VOICES))
+            pygame.mixer.set_num_channels(n)
+            self.channels = [pygame.mixer.Channel(i) for i in range(n)]
+            self.started = [0] * n      # when each channel was last struck, in ns
+            self.keys = {}              # sample number -> channel index it last played on
+            self.owner = [None] * n     # channel index -> sample number playing on it
+
+    def strike(self, x):
+        "Play sample x on a voice of its own"
+        now = time.perf_counter_ns()
+        snd = audio[x]
+        with self.lock:
+            i = self.keys.get(x)
+            if i is None or self.owner[i] != x or not self.channels[i].get_busy():
+                # a re-struck key restarts on its own voice; otherwise take a free one or the oldest
+                free = [j for j, ch in enumerate(self.channels) if not ch.get_busy()]
+                if free:
+                    i = free[0]
+                else:
+                    i = min(range(len(self.channels)), key = self.started.__getitem__)
+                    if now - self.started[i] < STEAL_MS * 1e6:
+                        stats["notes_dropped"] += 1
+                        return
+                    stats["voices_stolen"] += 1
+            # the key leaves the voice it last played on, and the voice's last key loses it
+            j = self.keys.get(x)
+            if j is not None and j != i and self.owner[j] == x:
+                self.owner[j] = None
+            old = self.owner[i]
+            if old is not None and old != x and self.keys.get(old) == i:
+                del self.keys[old]
+            self.channels[i].play(snd)
+            self.started[i] = now
+            self.keys[x] = i
+            self.owner[i] = x
+
+def strike(x):
+    "Play sample x from its beginning"
+    voices.strike(x)
+
+def polyphony(times, ring = VOICE_MS):
+    "Most notes sounding at once if each rings for ring ms"
+    times = np.sort(times)
+    if not len(times): return 0
+    # for each onset, the notes begun less than ring ms earlier, itself included
+    return int((np.arange(len(times)) - np.searchsorted(times, times - ring, 'right') + 1).max())
+
+def song_array(m):
+    "Flatten the audible notes of a MidiFile into a NOTE_DTYPE array (times in seconds)"
+    notes = m.notes[m.notes["velocity"] > 0]
+    song = np.zeros(len(notes), dtype = NOTE_DTYPE)
+    for f in ("pitch", "time", "velocity", "channel"):
+        song[f] = notes[f]
+    song["duration"] = notes["length"]
+    return song
+
+# midicsv records read by read_csv: track, tick, then the record's own fields
+CSV_HEADER = re.compile(rb'^\s*0,\s*0,\s*Header,\s*(\d+),\s*(\d+),\s*(\d+)', re.M)
+CSV_TEMPO = re.compile(rb'\s*(\d+),\s*(\d+),\s*Tempo,\s*(\d+)')
+CSV_NOTE = re.compile(rb'^\s*\d+,\s*\d+,\s*Note_o(?:n|ff)_c,\s*\d+,\s*\d+,\s*\d+', re.M)
+
+def read_csv(fn):
+    """Read the notes of a midicsv file into a NOTE_DTYPE array, like song_array(MidiFile(...))
+    would for the MIDI file it came from"""
+    with open(fn, 'rb') as f:
+        data = f.read()
+    header = CSV_HEADER.search(data)
+    if header is None: raise Exception('Not a midicsv file')
+    division = int(header.group(3))
+    # tempo records are few, so look for them by name rather than matching every line
+    tmap = []
+    i = data.find(b"Tempo")
+    while i >= 0:
+        end = data.find(b"\n", i)
+        m = CSV_TEMPO.match(data, data.rfind(b"\n", 0, i) + 1, end if end >= 0 else len(data))
+        if m:
+            tmap.append((int(m.group(2)), int(m.group(3))))
+        i = data.find(b"Tempo", i + 5)
+    # the note records alone, with their type as a number, are read in one go
+    notes = b",".join(CSV_NOTE.findall(data)).replace(b"Note_on_c", b"1").replace(b"Note_off_c", b"0")
+    ev = np.fromstring(notes, dtype = np.int64, sep = ",").reshape(-1, 6) if notes else np.zeros((0, 6), np.int64)
+    track, tick, kind, channel, pitch, velocity = ev.T
+    # a note-on with velocity 0 is an off
+    on = (kind == 1) & (velocity > 0)
+
+    # pair every off with the last open note of its track, channel and pitch, as the parser does:
+    # within each key this is matching parentheses, so an off closes the on at its own nesting depth
+    n = len(ev)
+    key = (track * 16 + channel) * 128 + pitch
+    order = np.lexsort((np.arange(n), key))
+    k = key[order]
+    step = np.where(on[order], 1, -1)
+    first = np.r_[True, k[1:] != k[:-1]] if n else np.zeros(0, dtype = bool)
+    group = np.cumsum(first) - 1
+    depth = np.cumsum(step)
+    depth -= (depth - step)[first][group]
+    # offs that find no open note reach a new low; running minima restart per key by shifting each key lower
+    big = 2 * n + 2
+    low = np.minimum.accumulate(depth - group * big) + group * big
+    prev = np.minimum(np.r_[0, low[:-1]], 0)
+    prev[first] = 0
+    stray = (step < 0) & (depth < prev)
+    dropped = np.cumsum(stray)
+    depth += dropped - (dropped - stray)[first][group]
+    keep = ~stray
+    order, k, step, depth = order[keep], k[keep], step[keep], depth[keep]
+    level = np.where(step > 0, depth, depth + 1)
+    pairs = np.lexsort((np.arange(len(order)), level, k))
+    o, k, level, step = order[pairs], k[pairs], level[pairs], step[pairs]
+    closed = np.r_[(step[:-1] > 0) & (step[1:] < 0) & (k[:-1] == k[1:]) & (level[:-1] == level[1:]), False] \
+        if len(o) else np.zeros(0, dtype = bool)
+    ons = step > 0
+    start = o[ons]      # record of every note-on
+    end_tick = tick[start].copy()   # a note that is never closed ends where it starts
+    end_tick[closed[ons]] = tick[o[np.flatnonzero(ons & closed) + 1]]
+    # notes in the order of their note-on records
+    byline = np.argsort(start, kind = 'stable')
+    start, end_tick = start[byline], end_tick[byline]
+
+    song = np.zeros(len(start), dtype = NOTE_DTYPE)
+    song["pitch"] = pitch[start]
+    song["velocity"] = velocity[start]
+    song["channel"] = channel[start]
+    song["time"] = tick_seconds(tick[start], division, tmap)
+    song["duration"] = tick_seconds(end_tick, division, tmap) - song["time"]
+    return song
+
+def song_notes(song):
+    "Return onset times (ms) and sample numbers of the notes in a NOTE_DTYPE array"
+    return np.floor(1000 * song["time"]), song["pitch"].astype(np.int64) - 20
+
+def parse_song(fn):
+    "Return the notes of a song file, from the song cache if possible"
+    parse = lambda fn: read_csv(fn) if fn.endswith(".csv") else song_array(MidiFile(fn, workers = PARSE_WORKERS))
+    if SONG_CACHE is None:
+        return parse(fn)
+    return songcache.load(fn, NOTE_DTYPE, parse, SONG_CACHE)
+
+class Preloader(threading.Thread):
+    "Parses playlist entries in a worker thread so that switching songs does not stall a frame"
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon = True)
+        self.requests = queue.Queue()
+        self.ready = {}     # file name -> parsed song
+        self.lock = threading.Lock()
+
+    def want(self, fns):
+        "Parse these files ahead of time and drop any other parsed songs"
+        with self.lock:
+            self.ready = {fn: self.ready[fn] for fn in fns if fn in self.ready}
+        for fn in fns:
+            self.requests.put(fn)
+
+    def take(self, fn):
+        "Return the parsed song for fn, or None if it is not ready yet"
+        with self.lock:
+            return self.ready.get(fn)
+
+    def run(self):
+        while True:
+            fn = self.requests.get()
+            with self.lock:
+                if fn in self.ready: continue
+            song = parse_song(fn)
+            with self.lock:
+                self.ready[fn] = song
+
+preloader = Preloader()
+
+def load_song(s, res, fn, song = None):
+    "Load song data, parsing it now unless it has already been parsed"
+    song_report()
+    if song is None:
+        t0 = time.perf_counter()
+        song = parse_song(fn)
+        # count the frames the render loop spent waiting for the parser
+        stats["load_frames"] += math.ceil((time.perf_counter() - t0) * TARGET_FPS)
+    times, pitches = song_notes(song)
+    if not SOFT_MIX:
+        audio.preload(pitches)
+        voices.resize(polyphony(times))
+    schedule(times, pitches)
+    prerender(res)
+
+def schedule(times, pitches):
+    "Build the time-sorted note schedule and rewind playback"
+    global note_time, note_pitch, cursor, drawn, t, first, last, scrolled
+
+    hold()
+    order = np.argsort(times, kind = 'stable')
+    note_time = np.asarray(times, dtype = float)[order]
+    note_pitch = np.asarray(pitches, dtype = np.int64)[order]
+    if len(note_time):
+        first = note_time[0]
+        note_time -= first
+        last = note_time[-1]
+    else:
+        first, last = 0, -1
+    cursor = 0      # index of the next note to hand to the scheduler
+    drawn = 0       # index of the next note to mark on the piano roll
+    t = 0.          # song position in milliseconds
+    scrolled = 0    # piano roll pixels scrolled so far
+    scheduler.clear()
+    stats.update(jitter_ns = [], voices_stolen = 0, notes_dropped = 0)
+
+def hold():
+    "Stop the song clock, e.g. while paused; it restarts with the next play()"
+    global clock_ns, cursor
+    if clock_ns is not None:
+        # queued due times are only valid while the clock runs, so requeue the notes
+        # that have not fired yet on restart; they are the last ones handed over
+        cursor -= scheduler.clear()
+    clock_ns = None
+
+def seek(res, ms):
+    "Jump to song position ms without playing the notes in between"
+    global t, cursor, drawn, scrolled, clock_ns, dirty
+    scheduler.clear()
+    t = min(max(float(ms), 0.), max(last, 0.))
+    # note_time is sorted, so finding the next note is a binary search
+    cursor = drawn = int(np.searchsorted(note_time, t))
+    scrolled = int(t * SCROLL)
+    clock_ns = None
+    if tiles is None:
+        roll_redraw(res)
+    dirty = True
+
+def song_report():
+    "Log how late the notes of the current song were fired and how its voices were allocated"
+    if not log.isEnabledFor(logging.INFO):
+        return      # full_size() below opens every sample file
+    j = np.array(stats["jitter_ns"]) / 1e6
+    if len(j):
+        log.info("jitter (ms): mean %.2f, p99 %.2f, max %.2f over %u notes",
+            j.mean(), np.percentile(j, 99), j.max(), len(j))
+        if SOFT_MIX:
+            log.info("mixer: %u blocks of %u frames, %u underruns, up to %u voices",
+                scheduler.blocks, scheduler.block, scheduler.underruns, scheduler.peak)
+            log.info("samples: %u keys mixed, %.1f MB held",
+                len(scheduler.samples), sum(a.nbytes for a in scheduler.samples.values()) / 2**20)
+        else:
+            log.info("voices: %u channels, %u stolen, %u notes dropped",
+                len(voices.channels), stats["voices_stolen"], stats["notes_dropped"])
+            if audio.step > 1:
+                held = audio.size + audio.source_size
+                log.info("samples: %u kept keys, %u sounds, %.1f MB held, %.1f MB less than every key decoded",
+                    len(audio.sources), len(audio.sounds), held / 2**20, (audio.full_size() - held) / 2**20)
+
+def play(s, res, now, tfac):
+    "Advance the song to wall-clock time now (ns) and queue the notes due next"
+    global t, cursor, drawn, scrolled, clock_ns, dirty
+    # the song position follows the monotonic clock, scaled by the user tempo
+    if clock_ns is not None:
+        t += (now - clock_ns) / 1e6 * tfac
+    clock_ns = now
+    t0 = time.perf_counter_ns()
+    px = int(t * SCROLL) - scrolled
+    if px > 0:
+        if tiles is None:
+            roll_advance(res, px)
+        scrolled += px
+        dirty = True
+    # notes before the cursor are already queued, so only look up the end of the look-ahead window
+    t1 = time.perf_counter_ns()
+    end = int(np.searchsorted(note_time, t + LOOKAHEAD))
+    due = note_time[cursor:end].tolist()
+    pitches = note_pitch[cursor:end].tolist()
+    # notes requeued after a pause are on the roll already
+    new = pitches[max(drawn - cursor, 0):]
+    cursor = end
+    drawn = max(drawn, end)
+    t2 = time.perf_counter_ns()
+    for y, x in zip(due, pitches):
+        scheduler.add(now + int((y - t) / tfac * 1e6), x)
+    t3 = time.perf_counter_ns()
+    if tiles is None:
+        for x in new:
+            roll_note(res, x)
+    t4 = time.perf_counter_ns()
+    trace.add("scroll", t0, t1)
+    trace.add("scan", t1, t2)
+    trace.add("schedule", t2, t3)
+    trace.add("notes", t3, t4)
+    stats["frames"] += 1
+    stats["scan_ns"] = t2 - t1
+    stats["scan_total_ns"] += t2 - t1
+    stats["schedule_ns"] += t3 - t1
+    stats["draw_ns"] += (t1 - t0) + (t4 - t3)
     # end of song?
-    if t <= last + RES[0] * rinc:
+    if t <= last + res[0] / SCROLL:
         return True
     else:
         return False
         
 class MIDI:
-    def __init__(self):
+    def __init__(self, song_dir = SONG_DIR, fps = TARGET_FPS, clock = time.perf_counter_ns, loop = True):
+        self.fps = fps          # frame rate cap, 0 for none
+        self.now = clock        # song time source in ns
+        self.loop = loop        # start over after the last song
+        self.frame_log = None   # a list to collect per-frame phase times in ns
         pygame.init()
         pygame.mixer.init()
         self.res = RES
         self.screen = pygame.display.set_mode(self.res)
         pygame.display.set_caption('midi')
         self.screen.fill(BACKGROUND)
+        pygame.display.flip()
+        self.caption = None
         self.clock = pygame.time.Clock()
         ini(self.screen, self.res)
-        self.calib = 10
-        self.samp = []
-        self.last = 0
-        self.mlist = sorted(glob.glob(SONG_DIR + "/*.mid"))
+        scheduler.start()
+        preloader.start()
+        self.mlist = sorted(glob.glob(song_dir + "/*.mid") + glob.glob(song_dir + "/*.csv"))
         self.mselect = 0
-        load_song(self.screen, self.res, self.mlist[self.mselect])
+        fn = self.mlist[self.mselect]
+        load_song(self.screen, self.res, fn, parse_song(fn))
+        self.preload()
         self.tempo = 1
         self.paused = False
+        self.seek_to = None     # song position in ms to jump to before the next frame
+        self.histogram = False  # show the frame time histogram
+        self.frame_starts = collections.deque(maxlen = 241)     # for the histogram, in ns
+        self.dump = False       # write out the frame trace after this frame
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda sig, frame: setattr(self, "dump", True))
 
     def events(self):
+        global dirty
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
             if event.type == pygame.KEYDOWN and event.key == pygame.K_RIGHT:
-                self.mselect += 1
-                self.mselect = self.mselect % len(self.mlist)
-                load_song(self.screen, self.res, self.mlist[self.mselect])
+                self.select(1)
             if event.type == pygame.KEYDOWN and event.key == pygame.K_LEFT:
-                self.mselect -= 1
-                self.mselect = self.mselect % len(self.mlist)
-                load_song(self.screen, self.res, self.mlist[self.mselect])
+                self.select(-1)
             if event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
                 self.tempo += 0.05
             if event.type == pygame.KEYDOWN and event.key == pygame.K_DOWN:
                 self.tempo -= 0.05
             if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
                 self.paused = not self.paused
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_HOME:
+                self.seek_to = 0
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_PAGEUP:
+                self.seek_to = self.position() - SEEK_MS
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_PAGEDOWN:
+                self.seek_to = self.position() + SEEK_MS
+            if event.type == pygame.KEYDOWN and pygame.K_0 <= event.key <= pygame.K_9:
+                # number keys jump to that tenth of the song
+                self.seek_to = (event.key - pygame.K_0) / 10 * max(last, 0)
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_t:
+                self.dump = True
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_h:
+                self.histogram = not self.histogram
+                if not self.histogram:
+                    self.screen.fill(BACKGROUND, [0, 0, *HISTOGRAM])
+                    pygame.display.update([0, 0, *HISTOGRAM])
+                    dirty = True
+            if event.type == pygame.MOUSEMOTION and event.buttons[0]:
+                # drag the piano roll like a tape to scrub through the song
+                self.seek_to = self.position() - event.rel[0] / SCROLL
+        if self.seek_to is not None:
+            seek(self.res, self.seek_to)
+            self.seek_to = None
+
+    def position(self):
+        "Song position in ms, taking a jump asked for in this frame into account"
+        return t if self.seek_to is None else self.seek_to
+
+    def preload(self):
+        "Have the next and previous songs in the playlist parsed in the background"
+        n = len(self.mlist)
+        preloader.want([self.mlist[(self.mselect + 1) % n], self.mlist[(self.mselect - 1) % n]])
+
+    def select(self, step):
+        "Switch to the song step entries away in the playlist"
+        self.mselect += step
+        self.mselect = self.mselect % len(self.mlist)
+        fn = self.mlist[self.mselect]
+        load_song(self.screen, self.res, fn, preloader.take(fn))
+        self.preload()
 
     def run(self):
         self.running = True
         while self.running:
-            self.clock.tick(60)
+            t = time.perf_counter_ns()
+            self.clock.tick(self.fps)
+            t0 = time.perf_counter_ns()
             self.events()
+            t1 = time.perf_counter_ns()
             self.update()
+            t2 = time.perf_counter_ns()
+            trace.add("tick", t, t0)
+            trace.add("events", t0, t1)
+            trace.add("frame", t, t2)
+            self.frame_starts.append(t)
+            if self.frame_log is not None:
+                self.frame_log.append((t1 - t0, stats["schedule_ns"], stats["draw_ns"], stats["flip_ns"],
+                    t2 - t0))
+            if self.dump:
+                self.dump = False
+                fn = time.strftime("midi-trace-%Y%m%d-%H%M%S.json")
+                trace.dump(fn)
+                print("frame trace written to", fn)
         pygame.quit()
 
+    def overlay(self):
+        "Draw a histogram of the last 240 frame times in the top left corner and return its rectangle"
+        w, h = HISTOGRAM
+        box = pygame.Rect(0, 0, w, h)
+        self.screen.fill((40, 40, 40), box)
+        ms = np.diff(np.array(self.frame_starts, dtype = float)) / 1e6
+        if len(ms):
+            # 2 ms bins up to 50 ms, the last one taking everything longer
+            counts = np.bincount(np.minimum(ms // 2, 24).astype(int), minlength = 25)
+            bw = w // 25
+            for i, n in enumerate(counts.tolist()):
+                if n:
+                    bh = max(1, (h - 2) * n // int(counts.max()))
+                    pygame.draw.rect(self.screen, (200, 200, 200), [i * bw, h - bh, bw - 1, bh])
+            # one frame at the target rate
+            x = int(500 / TARGET_FPS * bw)
+            pygame.draw.line(self.screen, (255, 80, 80), (x, 0), (x, h - 1))
+        return box
+
     def update(self):
-        # measure FPS for automatic adjustment
-        if self.calib > 0:
-            f = 1 / (time.time() - self.last)
-            self.last = time.time()
-            self.calib -= 1
-            self.samp.append(f)
-            self.fps = statistics.median(self.samp)
-            print("FPS", self.fps)
-            return
+        stats.update(schedule_ns = 0, draw_ns = 0, flip_ns = 0)
         self.tempo = max(0.1, min(3, self.tempo))
-        pygame.display.set_caption('midi (%s , tempo %.2f)' % (self.mlist[self.mselect], self.tempo))
-        if self.paused: return
+        caption = 'midi (%s , tempo %.2f)' % (self.mlist[self.mselect], self.tempo)
+        if caption != self.caption:
+            t0 = time.perf_counter_ns()
+            pygame.display.set_caption(caption)
+            self.caption = caption
+            trace.add("caption", t0, time.perf_counter_ns())
+        if self.paused:
+            # still show where a seek while paused went
+            hold()
         # play notes
-        if not play(self.screen, self.res, TARGET_FPS / self.fps, self.tempo):
+        elif not play(self.screen, self.res, self.now(), self.tempo):
+            if not self.loop and self.mselect == len(self.mlist) - 1:
+                self.running = False
+                return
             # advance to next song in playlist
-            self.mselect += 1
-            self.mselect = self.mselect % len(self.mlist)
-            load_song(self.screen, self.res, self.mlist[self.mselect])
-            
-        pygame.display.flip()
+            self.select(1)
+        # only push the part of the window that changed
+        t0 = time.perf_counter_ns()
+        rects = present(self.screen, self.res)
+        if self.histogram:
+            rects.append(self.overlay())
+        t1 = time.perf_counter_ns()
+        if rects:
+            pygame.display.update(rects)
+        t2 = time.perf_counter_ns()
+        trace.add("present", t0, t1)
+        trace.add("flip", t1, t2)
+        stats["draw_ns"] += t1 - t0
+        stats["flip_ns"] = t2 - t1
 
-c = MIDI()
-c.run()
+if __name__ == "__main__":
+    logging.basicConfig(level = os.environ.get("MIDI_LOG", "warning").upper(), format = "%(name)s: %(message)s")
+    c = MIDI()
+    c.run()
 
         
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Melodic motif search over a directory of MIDI files
+
+# The top line of every track is reduced to the intervals between its
+# notes, so a motif is found in any transposition. Every position of
+# every melody is indexed by the NGRAM intervals that follow it, packed
+# into one integer key; the sorted keys form an inverted index that is
+# memory-mapped and searched with a binary search. Indexing a file keeps
+# its melodies on disk too, so when files are added or changed only those
+# are parsed again and the index is rebuilt from the stored melodies.
+
+# Usage:
+
+# python motif.py index [dir ...]       index every .mid file in the directories, or bring the index up to date
+# python motif.py query NOTE NOTE ...   find a motif, given as MIDI note numbers or names like G4, F#5 or Bb3
+
+import sys, os, re, json, glob, time, hashlib, threading
+import numpy as np
+import midi
+
+INDEX_DIR = ".motifindex"
+NGRAM = 5           # intervals per index key, so motifs of up to NGRAM + 1 notes need one lookup
+SEP = 1000          # melody value between tracks; no interval to or from it is a valid one
+
+def melodies(fn):
+    """Return the top line of every track of a MIDI file as pitch, track and onset time (seconds) arrays,
+    each track followed by SEP"""
+    notes = midi.MidiFile(fn).notes
+    notes = notes[notes["velocity"] > 0]
+    # the highest of the notes struck together
+    order = np.lexsort((-notes["pitch"].astype(int), notes["start"], notes["track"]))
+    notes = notes[order]
+    top = np.r_[True, (notes["track"][1:] != notes["track"][:-1]) | (notes["start"][1:] != notes["start"][:-1])] \
+        if len(notes) else np.zeros(0, dtype = bool)
+    notes = notes[top]
+    ends = np.flatnonzero(np.r_[notes["track"][1:] != notes["track"][:-1], True]) + 1 if len(notes) else []
+    pitch = np.insert(notes["pitch"].astype(np.int16), ends, SEP)
+    track = np.insert(notes["track"], ends, notes["track"][np.asarray(ends, dtype = int) - 1])
+    onset = np.insert(notes["time"].astype(np.float32), ends, np.nan)
+    return pitch, track, onset
+
+def interval_bytes(pitch):
+    "Intervals from every position of a melody to the next as bytes 1..255, 0 where the melody ends"
+    d = np.diff(pitch.astype(np.int64), append = SEP)
+    return np.where(np.abs(d) <= 127, d + 128, 0).astype(np.uint64)
+
+def keys(pitch, n = NGRAM):
+    "The index key of every position of a melody: the bytes of the n intervals that follow it, first one highest"
+    b = np.concatenate((interval_bytes(pitch), np.zeros(n, dtype = np.uint64)))
+    k = np.zeros(len(pitch), dtype = np.uint64)
+    for j in range(n):
+        k = (k << np.uint64(8)) | b[j:j + len(pitch)]
+    return k
+
+def entry(fn, index_dir):
+    "Path of the stored melodies of file fn"
+    return os.path.join(index_dir, hashlib.sha1(os.path.abspath(fn).encode()).hexdigest() + ".npz")
+
+def replace(path, write):
+    "Write a file through write(f) under a temporary name and move it into place"
+    tmp = "%s.%u.%u.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def update(dirs, index_dir = INDEX_DIR):
+    "Index the MIDI files in the directories, parsing only new and changed files; return how many were parsed"
+    os.makedirs(index_dir, exist_ok = True)
+    try:
+        with open(os.path.join(index_dir, "files.json")) as f:
+            files = {os.path.abspath(fn): v for fn, v in json.load(f).items()}
+    except (OSError, ValueError):
+        files = {}
+    found = sorted(os.path.abspath(fn) for d in dirs for fn in glob.glob(os.path.join(d, "*.mid")))
+    parsed = 0
+    for fn in found:
+        st = os.stat(fn)
+        old = files.get(fn)
+        if old and (old["mtime_ns"], old["size"]) == (st.st_mtime_ns, st.st_size):
+            continue
+        pitch, track, onset = melodies(fn)
+        replace(entry(fn, index_dir), lambda f: np.savez(f, pitch = pitch, track = track, onset = onset))
+        files[fn] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+        parsed += 1
+    # files indexed from other directories stay until they are deleted
+    gone = [fn for fn in files if not os.path.exists(fn)]
+    for fn in gone:
+        del files[fn]
+        try:
+            os.remove(entry(fn, index_dir))
+        except OSError:
+            pass
+    if parsed or gone or not os.path.exists(os.path.join(index_dir, "keys.npy")):
+        build(files, index_dir)
+    replace(os.path.join(index_dir, "files.json"), lambda f: f.write(json.dumps(files, indent = 1).encode()))
+    return parsed
+
+def build(files, index_dir = INDEX_DIR):
+    "Rebuild the inverted index from the stored melodies of the files"
+    names = sorted(files)
+    parts = [np.load(entry(fn, index_dir)) for fn in names]
+    pitch = np.concatenate([p["pitch"] for p in parts] + [np.zeros(0, np.int16)])
+    track = np.concatenate([p["track"] for p in parts] + [np.zeros(0, np.uint16)])
+    onset = np.concatenate([p["onset"] for p in parts] + [np.zeros(0, np.float32)])
+    owner = np.repeat(np.arange(len(names), dtype = np.int32), [len(p["pitch"]) for p in parts])
+    k = keys(pitch)
+    where = np.flatnonzero(pitch != SEP)
+    where = where[np.argsort(k[where], kind = 'stable')]
+    arrays = {"pitch": pitch, "track": track, "onset": onset, "owner": owner, "keys": k[where], "where": where}
+    for name, a in arrays.items():
+        replace(os.path.join(index_dir, name + ".npy"), lambda f: np.save(f, a))
+    replace(os.path.join(index_dir, "names.json"), lambda f: f.write(json.dumps(names).encode()))
+
+class Index:
+    "The on-disk motif index, memory-mapped"
+
+    def __init__(self, index_dir = INDEX_DIR):
+        load = lambda name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode = 'r')
+        self.pitch, self.track, self.onset, self.owner = load("pitch"), load("track"), load("onset"), load("owner")
+        self.keys, self.where = load("keys"), load("where")
+        with open(os.path.join(index_dir, "names.json")) as f:
+            self.names = json.load(f)
+
+    def search(self, pitches):
+        "Return (file, track, onset in seconds) of every occurrence of the motif, in any transposition"
+        q = np.diff(np.asarray(pitches, dtype = np.int64))
+        if not len(q): raise ValueError("a motif needs at least two notes")
+        if np.abs(q).max() > 127: raise ValueError("interval out of range")
+        n = min(len(q), NGRAM)
+        # a shorter motif is a prefix of the keys, i.e. a range of them
+        lo = 0
+        for d in q[:n].tolist():
+            lo = (lo << 8) | (d + 128)
+        shift = 8 * (NGRAM - n)
+        a = int(np.searchsorted(self.keys, np.uint64(lo << shift)))
+        b = int(np.searchsorted(self.keys, np.uint64(((lo + 1) << shift) - 1), 'right'))
+        found = np.sort(self.where[a:b])
+        if len(q) > NGRAM:
+            # check the notes beyond the key against the melodies
+            idx = found[:, None] + np.arange(len(q) + 1)
+            ok = (idx < len(self.pitch)).all(axis = 1)
+            found, idx = found[ok], idx[ok]
+            found = found[(np.diff(self.pitch[idx].astype(np.int64), axis = 1) == q).all(axis = 1)]
+        return [(self.names[self.owner[i]], int(self.track[i]), float(self.onset[i])) for i in found.tolist()]
+
+note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def note_number(s):
+    "MIDI note number of a number or a note name like C4 (middle C), F#5 or Bb3"
+    if s.isdigit():
+        return int(s)
+    m = re.match(r'([A-Ga-g])([#b]?)(-?\d+)$', s)
+    if m is None: raise ValueError("not a note: " + s)
+    n = note_names.index(m.group(1).upper()) + {"": 0, "#": 1, "b": -1}[m.group(2)]
+    return 12 * (int(m.group(3)) + 1) + n
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("index", "query") or (sys.argv[1] == "query" and len(sys.argv) < 4):
+        print("usage: python motif.py index [dir ...] | query NOTE NOTE ...")
+        sys.exit(1)
+    if sys.argv[1] == "index":
+        t0 = time.perf_counter()
+        parsed = update(sys.argv[2:] or [midi.SONG_DIR])
+        print("%u files parsed, index up to date in %.0f ms" % (parsed, 1000 * (time.perf_counter() - t0)))
+    else:
+        t0 = time.perf_counter()
+        index = Index()
+        found = index.search([note_number(s) for s in sys.argv[2:]])
+        dt = time.perf_counter() - t0
+        for fn, track, onset in found:
+            print("%-32s track %2u %8.2f s" % (fn, track, onset))
+        print("%u occurrences in %.2f ms" % (len(found), 1000 * dt))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Render songs to WAV files faster than real time, without a display or sound card
+
+# Usage:
+
+# python render.py file.mid [file.wav]
+# python render.py --batch [dir] [outdir]     render every .mid file in dir using all CPU cores
+
+import sys, os, wave, glob, time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import midi
+
+def write_wav(fn, buf, rate = midi.SAMPLE_RATE):
+    "Write a mono float buffer as a 16-bit WAV file"
+    pcm = (np.clip(buf, -1, 1) * 32767).astype('<i2')
+    with wave.open(fn, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+
+def render(fn, out, samples = None):
+    "Render song fn to the WAV file out and return its length in seconds"
+    if samples is None:
+        samples = midi.read_samples()
+    buf = midi.mix(midi.parse_song(fn), samples)
+    write_wav(out, buf)
+    return len(buf) / midi.SAMPLE_RATE
+
+def share_samples(samples):
+    "Copy the samples into one shared memory block; return it and its (sample, offset, length) table"
+    table, pos = [], 0
+    for x, a in sorted(samples.items()):
+        table.append((x, pos, len(a)))
+        pos += len(a)
+    shm = shared_memory.SharedMemory(create = True, size = max(4 * pos, 1))
+    buf = np.ndarray(pos, dtype = np.float32, buffer = shm.buf)
+    for x, start, n in table:
+        buf[start:start + n] = samples[x]
+    return shm, table
+
+def attach_samples(name, table):
+    "Process pool initializer: map the shared samples into this worker without copying them"
+    global worker_shm, worker_samples
+    worker_shm = shared_memory.SharedMemory(name = name)
+    buf = np.ndarray(sum(n for x, start, n in table), dtype = np.float32, buffer = worker_shm.buf)
+    # shared by every worker, so no render may write to it
+    buf.flags.writeable = False
+    worker_samples = {x: buf[start:start + n] for x, start, n in table}
+
+def render_job(job):
+    "Render one song in a pool worker and time it"
+    fn, out = job
+    t0 = time.perf_counter()
+    length = render(fn, out, worker_samples)
+    return fn, length, time.perf_counter() - t0
+
+def batch(song_dir = midi.SONG_DIR, out_dir = ".", workers = None):
+    "Render every MIDI file in song_dir to out_dir with a process pool and report throughput"
+    files = sorted(glob.glob(os.path.join(song_dir, "*.mid")))
+    jobs = [(fn, os.path.join(out_dir, os.path.splitext(os.path.basename(fn))[0] + ".wav")) for fn in files]
+    os.makedirs(out_dir, exist_ok = True)
+    t0 = time.perf_counter()
+    shm, table = share_samples(midi.read_samples())
+    try:
+        with ProcessPoolExecutor(workers, initializer = attach_samples, initargs = (shm.name, table)) as pool:
+            # map() returns results in submission order, so the report is deterministic
+            results = list(pool.map(render_job, jobs))
+    finally:
+        shm.close()
+        shm.unlink()
+    wall = time.perf_counter() - t0
+    audio = 0
+    for fn, length, dt in results:
+        audio += length
+        print("%-32s %8.1f s audio %8.1f ms %7.0fx" % (os.path.basename(fn), length, 1000 * dt, length / dt))
+    print("%u files, %.1f s audio in %.2f s: %.1f files/s, %.0fx real time" %
+        (len(results), audio, wall, len(results) / wall, audio / wall))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        batch(*sys.argv[2:4])
+        sys.exit(0)
+    if len(sys.argv) < 2:
+        print("usage: python render.py file.mid [file.wav] | --batch [dir] [outdir]")
+        sys.exit(1)
+    fn = sys.argv[1]
+    out = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(os.path.basename(fn))[0] + ".wav"
+    print("%s: %.1f s of audio" % (out, render(fn, out)))
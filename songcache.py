@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# On-disk cache of parsed songs
+
+# Each song is stored as one file holding a small header followed by the
+# raw note records, so a cached song is loaded by memory-mapping it.
+# Entries are keyed by the path of the MIDI file and validated against
+# its mtime and size, falling back to a content hash when those changed.
+
+# Usage:
+
+# python songcache.py [dir ...]    parse and cache every .mid file in the directories
+
+import sys, os, struct, hashlib, glob, threading
+import numpy as np
+
+CACHE_DIR = ".midicache"
+MAGIC = b'MIDC'
+VERSION = 1
+# magic, version, record size, source mtime (ns), source size, source SHA-1, record count
+HEADER = struct.Struct('<4sHHqq20sq')
+
+def entry(fn, cache_dir = CACHE_DIR):
+    "Path of the cache file for song fn"
+    key = hashlib.sha1(os.path.abspath(fn).encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".notes")
+
+def digest(fn):
+    with open(fn, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+def read(fn, dtype, cache_dir = CACHE_DIR):
+    "Return the cached notes of fn as a read-only memory-mapped array, or None if missing or stale"
+    path = entry(fn, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEADER.size)
+            length = os.fstat(f.fileno()).st_size
+        magic, version, itemsize, mtime, size, sha, count = HEADER.unpack(head)
+        st = os.stat(fn)
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != VERSION or itemsize != dtype.itemsize:
+        return None
+    if HEADER.size + count * itemsize > length:
+        # cut short, e.g. by a full disk
+        return None
+    if (st.st_mtime_ns, st.st_size) != (mtime, size):
+        # the file was touched or copied; only its content decides
+        if digest(fn) != sha:
+            return None
+        with open(path, 'r+b') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, itemsize, st.st_mtime_ns, st.st_size, sha, count))
+    if count == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype = dtype, mode = 'r', offset = HEADER.size, shape = (count,))
+
+def write(fn, notes, cache_dir = CACHE_DIR):
+    "Store the notes of fn in the cache"
+    st = os.stat(fn)
+    notes = np.ascontiguousarray(notes)
+    os.makedirs(cache_dir, exist_ok = True)
+    path = entry(fn, cache_dir)
+    tmp = "%s.%u.%u.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, notes.dtype.itemsize,
+            st.st_mtime_ns, st.st_size, digest(fn), len(notes)))
+        f.write(notes.tobytes())
+    os.replace(tmp, path)
+
+def load(fn, dtype, parse, cache_dir = CACHE_DIR):
+    "Return the notes of fn from the cache, calling parse(fn) and caching the result on a miss"
+    notes = read(fn, dtype, cache_dir)
+    if notes is None:
+        notes = parse(fn)
+        try:
+            write(fn, notes, cache_dir)
+        except OSError:
+            pass    # a read-only cache directory only costs the next parse
+    return notes
+
+def warm(dirs):
+    "Parse and cache every MIDI file in the given directories"
+    import midi
+    for d in dirs:
+        for fn in sorted(glob.glob(os.path.join(d, "*.mid"))):
+            hit = read(fn, midi.NOTE_DTYPE) is not None
+            notes = midi.parse_song(fn)
+            print("%-40s %6u notes %s" % (fn, len(notes), "cached" if hit else "parsed"))
+
+if __name__ == "__main__":
+    import midi
+    warm(sys.argv[1:] or [midi.SONG_DIR])